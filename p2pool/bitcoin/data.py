@@ -4,7 +4,7 @@ import hashlib
 import random
 
 import p2pool
-from p2pool.util import math, pack
+from p2pool.util import math, memoize, pack
 
 def hash256(data):
     return pack.IntType(256).unpack(hashlib.sha256(hashlib.sha256(data).digest()).digest())
@@ -226,13 +226,28 @@ def difficulty_to_target(difficulty):
 
 base58_alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+_base58_values = dict((char, i) for i, char in enumerate(base58_alphabet))
+_base58_pairs = [a + b for a in base58_alphabet for b in base58_alphabet] # two digits per divmod
+
 def base58_encode(bindata):
     bindata2 = bindata.lstrip(chr(0))
-    return base58_alphabet[0]*(len(bindata) - len(bindata2)) + math.natural_to_string(math.string_to_natural(bindata2), base58_alphabet)
+    n = int(bindata2.encode('hex'), 16) if bindata2 else 0
+    res = []
+    while n:
+        n, x = divmod(n, 58*58)
+        res.append(_base58_pairs[x])
+    res.reverse()
+    return base58_alphabet[0]*(len(bindata) - len(bindata2)) + ''.join(res).lstrip(base58_alphabet[0])
 
 def base58_decode(b58data):
     b58data2 = b58data.lstrip(base58_alphabet[0])
-    return chr(0)*(len(b58data) - len(b58data2)) + math.natural_to_string(math.string_to_natural(b58data2, base58_alphabet))
+    n = 0
+    for char in b58data2:
+        try:
+            n = n*58 + _base58_values[char]
+        except KeyError:
+            raise ValueError('invalid base58 character %r' % (char,))
+    return chr(0)*(len(b58data) - len(b58data2)) + math.natural_to_string(n)
 
 human_address_type = ChecksummedType(pack.ComposedType([
     ('version', pack.IntType(8)),
@@ -260,6 +275,7 @@ def pubkey_to_script2(pubkey):
 def pubkey_hash_to_script2(pubkey_hash):
     return '\x76\xa9' + ('\x14' + pack.IntType(160).pack(pubkey_hash)) + '\x88\xac'
 
+@memoize.memoize_with_backing(memoize.LRUDict(10000)) # called for every payout output by the web interface
 def script2_to_address(script2, net):
     try:
         pubkey = script2[1:-1]
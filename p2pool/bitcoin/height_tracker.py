@@ -1,29 +1,133 @@
+import array
+import collections
+import os
+import struct
+
 from twisted.internet import defer, task
 from twisted.python import log
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral, forest, jsonrpc, variable
+from p2pool.util import deferral, jsonrpc, variable
+
+def _atomic_write(filename, data):
+    # so that a crash while saving leaves the previous file rather than a truncated one
+    with open(filename + '.new', 'wb') as f:
+        f.write(data)
+        f.flush()
+        try:
+            os.fsync(f.fileno())
+        except:
+            pass
+    try:
+        os.rename(filename + '.new', filename)
+    except: # XXX windows can't overwrite
+        os.remove(filename)
+        os.rename(filename + '.new', filename)
 
-class HeaderWrapper(object):
-    __slots__ = 'hash previous_hash'.split(' ')
+class HeaderIndex(object):
+    '''
+    Block header hashes and their chain heights, kept in flat arrays indexed
+    by slot number. Headers can be added in any order. Chains are joined
+    with a weighted union-find, so a header's height and the earliest block
+    of its chain are found in amortized constant time.
+    '''
     
-    @classmethod
-    def from_header(cls, header):
-        return cls(bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header)), header['previous_block'])
+    def __init__(self):
+        self._slots = {} # hash -> slot
+        self._hashes = []
+        self._previous_hashes = []
+        self._parents = array.array('l') # slot of an ancestor, or itself for the earliest known block of a chain
+        self._offsets = array.array('l') # height above that ancestor
+        self._waiting = {} # previous hash -> slots of chains that continue from it
     
-    def __init__(self, hash, previous_hash):
-        self.hash, self.previous_hash = hash, previous_hash
+    def __len__(self):
+        return len(self._hashes)
+    
+    def __contains__(self, hash):
+        return hash in self._slots
+    
+    def add(self, items):
+        '''
+        Adds (hash, previous_hash) pairs, returning the number that were new.
+        '''
+        
+        new_slots = []
+        for hash, previous_hash in items:
+            if hash in self._slots:
+                continue
+            slot = len(self._hashes)
+            self._slots[hash] = slot
+            self._hashes.append(hash)
+            self._previous_hashes.append(previous_hash)
+            self._parents.append(slot)
+            self._offsets.append(0)
+            new_slots.append(slot)
+        
+        for slot in new_slots:
+            previous_hash = self._previous_hashes[slot]
+            if previous_hash in self._slots:
+                self._link(slot, self._slots[previous_hash])
+            else:
+                self._waiting.setdefault(previous_hash, []).append(slot)
+            for child in self._waiting.pop(self._hashes[slot], []):
+                self._link(child, slot)
+        return len(new_slots)
+    
+    def items(self):
+        return zip(self._hashes, self._previous_hashes)
+    
+    def _find(self, slot):
+        path = []
+        while self._parents[slot] != slot:
+            path.append(slot)
+            slot = self._parents[slot]
+        root = slot
+        offset = 0
+        for slot in reversed(path):
+            offset += self._offsets[slot]
+            self._offsets[slot] = offset
+            self._parents[slot] = root
+        return root, offset
+    
+    def _link(self, child_root, parent):
+        root, offset = self._find(parent)
+        self._parents[child_root] = root
+        self._offsets[child_root] = offset + 1
+    
+    def get_height_and_last(self, hash):
+        '''
+        Returns the number of known blocks in the chain ending at hash and the
+        hash of the first block before them that isn't known, like
+        forest.Tracker.get_height_and_last.
+        '''
+        
+        slot = self._slots.get(hash, None)
+        if slot is None:
+            return 0, hash
+        root, offset = self._find(slot)
+        return offset + 1, self._previous_hashes[root]
 
 class HeightTracker(object):
     '''Point this at a factory and let it take care of getting block heights'''
     
-    def __init__(self, best_block_func, factory, backlog_needed):
+    def __init__(self, best_block_func, factory, backlog_needed, path=None):
         self._best_block_func = best_block_func
         self._factory = factory
         self._backlog_needed = backlog_needed
+        self._path = path
         
-        self._tracker = forest.Tracker()
+        self._index = HeaderIndex()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._index.add((int(data[i:i + 32].encode('hex'), 16), int(data[i + 32:i + 64].encode('hex'), 16)) for i in xrange(0, len(data) - 63, 64))
+            except:
+                log.err(None, 'Error loading block headers:')
+            else:
+                print 'Loaded %i block headers' % (len(self._index),)
+        self._saved_size = len(self._index)
         
         self._watch1 = self._factory.new_headers.watch(self._heard_headers)
         self._watch2 = self._factory.new_block.watch(self._request)
@@ -40,13 +144,16 @@ class HeightTracker(object):
         self._think_task.start(15)
         self._think2_task = task.LoopingCall(self._think2)
         self._think2_task.start(15)
+        if path is not None:
+            self._save_task = task.LoopingCall(self._save)
+            self._save_task.start(60, now=False)
     
     def _think(self):
         try:
-            highest_head = max(self._tracker.heads, key=lambda h: self._tracker.get_height_and_last(h)[0]) if self._tracker.heads else None
-            if highest_head is None:
+            best_block = self._best_block_func()
+            if best_block not in self._index:
                 return # wait for think2
-            height, last = self._tracker.get_height_and_last(highest_head)
+            height, last = self._index.get_height_and_last(best_block)
             if height < self._backlog_needed:
                 self._request(last)
         except:
@@ -56,24 +163,23 @@ class HeightTracker(object):
         self._request(self._best_block_func())
     
     def _heard_headers(self, headers):
-        changed = False
-        for header in headers:
-            hw = HeaderWrapper.from_header(header)
-            if hw.hash in self._tracker.items:
-                continue
-            changed = True
-            self._tracker.add(hw)
-        if changed:
+        if self._index.add((bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header)), header['previous_block']) for header in headers):
             self.updated.happened()
         self._think()
         
-        if len(self._tracker.items) >= self._last_notified_size + 100:
-            print 'Have %i/%i block headers' % (len(self._tracker.items), self._backlog_needed)
-            self._last_notified_size = len(self._tracker.items)
+        if len(self._index) >= self._last_notified_size + 100:
+            print 'Have %i/%i block headers' % (len(self._index), self._backlog_needed)
+            self._last_notified_size = len(self._index)
+    
+    def _save(self):
+        if len(self._index) == self._saved_size:
+            return
+        _atomic_write(self._path, ''.join(('%064x%064x' % (hash, previous_hash)).decode('hex') for hash, previous_hash in self._index.items()))
+        self._saved_size = len(self._index)
     
     @defer.inlineCallbacks
     def _request(self, last):
-        if last in self._tracker.items:
+        if last in self._index:
             return
         if last in self._requested:
             return
@@ -82,16 +188,73 @@ class HeightTracker(object):
     
     def get_height_rel_highest(self, block_hash):
         # callers: highest height can change during yields!
-        best_height, best_last = self._tracker.get_height_and_last(self._best_block_func())
-        height, last = self._tracker.get_height_and_last(block_hash)
+        best_height, best_last = self._index.get_height_and_last(self._best_block_func())
+        height, last = self._index.get_height_and_last(block_hash)
         if last != best_last:
             return -1000000000 # XXX hack
         return height - best_height
 
+class BlockHeightCache(object):
+    '''
+    Block hash -> height mapping for use as a DeferredCacher backing. Past
+    max_size entries, the least recently used are dropped. If path is given,
+    entries are loaded from it and save writes them back.
+    '''
+    
+    def __init__(self, path=None, max_size=10000):
+        self._path = path
+        self.max_size = max_size
+        self._heights = collections.OrderedDict() # least recently used first
+        self._dirty = False
+        
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                for i in xrange(0, len(data) - 35, 36):
+                    height, = struct.unpack('<I', data[i + 32:i + 36])
+                    self[int(data[i:i + 32].encode('hex'), 16)] = height
+            except:
+                log.err(None, 'Error loading block heights:')
+            self._dirty = False
+    
+    def __len__(self):
+        return len(self._heights)
+    
+    def __contains__(self, block_hash):
+        return block_hash in self._heights
+    
+    def __getitem__(self, block_hash):
+        height = self._heights.pop(block_hash)
+        self._heights[block_hash] = height
+        return height
+    
+    def __setitem__(self, block_hash, height):
+        self._heights.pop(block_hash, None)
+        self._heights[block_hash] = height
+        self._dirty = True
+        while len(self._heights) > self.max_size:
+            self._heights.popitem(last=False)
+    
+    def save(self):
+        if self._path is None or not self._dirty:
+            return
+        _atomic_write(self._path, ''.join(('%064x' % (block_hash,)).decode('hex') + struct.pack('<I', height) for block_hash, height in self._heights.iteritems()))
+        self._dirty = False
+
 @defer.inlineCallbacks
-def get_height_rel_highest_func(bitcoind, factory, best_block_func, net):
+def get_height_rel_highest_func(bitcoind, factory, best_block_func, net, block_headers_path=None, block_heights_path=None):
+    '''
+    The returned function has a prefetch attribute which takes block hashes
+    and returns a Deferred that fires once their heights are available.
+    '''
+    
     if '\ngetblock ' in (yield deferral.retry()(bitcoind.rpc_help)()):
-        @deferral.DeferredCacher
+        height_cache = BlockHeightCache(block_heights_path)
+        if block_heights_path is not None:
+            task.LoopingCall(height_cache.save).start(60, now=False)
+        
+        @deferral.DeferredCacher.with_backing(height_cache)
         @defer.inlineCallbacks
         def height_cacher(block_hash):
             try:
@@ -108,6 +271,10 @@ def get_height_rel_highest_func(bitcoind, factory, best_block_func, net):
             best_height = height_cacher.call_now(best_block_func(), 0)
             best_height_cached.set(max(best_height_cached.value, this_height, best_height))
             return this_height - best_height_cached.value
+        def prefetch(block_hashes):
+            return defer.DeferredList([height_cacher(block_hash) for block_hash in set(block_hashes) if block_hash not in height_cache], consumeErrors=True)
     else:
-        get_height_rel_highest = HeightTracker(best_block_func, factory, 5*net.SHARE_PERIOD*net.CHAIN_LENGTH/net.PARENT.BLOCK_PERIOD).get_height_rel_highest
+        get_height_rel_highest = HeightTracker(best_block_func, factory, 5*net.SHARE_PERIOD*net.CHAIN_LENGTH/net.PARENT.BLOCK_PERIOD, block_headers_path).get_height_rel_highest
+        prefetch = lambda block_hashes: defer.succeed(None) # headers are requested by the HeightTracker itself
+    get_height_rel_highest.prefetch = prefetch
     defer.returnValue(get_height_rel_highest)
@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import sys
 import time
 
@@ -17,67 +19,164 @@ def check(bitcoind, net):
         print >>sys.stderr, '    Bitcoin version too old! Upgrade to 0.6.4 or newer!'
         raise deferral.RetrySilentlyException()
 
+class BlockTemplate(dict):
+    '''
+    Block template from bitcoind. Two templates are equal if they have the same
+    fingerprint - everything that goes into the block being mined, with the
+    transactions reduced to a digest of their hashes - so setting a Variable to
+    a template identical to its current one doesn't fire changed. Things that
+    change on every poll, like the time, are returned separately by getwork.
+    '''
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.fingerprint = (self['version'], self['previous_block'], self['bits'].bits, self['subsidy'], self['coinbaseflags'], self['height'], self['use_getblocktemplate'],
+            hashlib.sha256(''.join('%064x' % (tx_hash,) for tx_hash in self['transaction_hashes'])).digest())
+    
+    def __eq__(self, other):
+        return isinstance(other, BlockTemplate) and self.fingerprint == other.fingerprint
+    
+    def __ne__(self, other):
+        return not self == other
+
+LONGPOLL_TIMEOUT = 5*60 # seconds; bitcoind answers a long poll once the template changes, which can take a while if nothing happens
+
 @deferral.retry('Error getting work from bitcoind:', 3)
 @defer.inlineCallbacks
-def getwork(bitcoind, use_getblocktemplate=False):
+def getwork(bitcoind, use_getblocktemplate=False, previous_template=None, longpollid=None):
+    '''
+    Returns (template, freshness), where freshness holds the template's time,
+    when it was fetched, the request's latency and its longpollid.
+    
+    Transactions that were already in previous_template aren't parsed again.
+    If longpollid is given, waits for bitcoind to have a template that differs
+    from the one with that longpollid first; latency is None then.
+    '''
     def go():
         if use_getblocktemplate:
             return bitcoind.rpc_getblocktemplate(dict(mode='template'))
         else:
             return bitcoind.rpc_getmemorypool()
-    try:
-        start = time.time()
-        work = yield go()
-        end = time.time()
-    except jsonrpc.Error_for_code(-32601): # Method not found
-        use_getblocktemplate = not use_getblocktemplate
+    work = None
+    if longpollid is not None and use_getblocktemplate:
+        try:
+            work = yield bitcoind.rpc_getblocktemplate(dict(mode='template', longpollid=longpollid), timeout=LONGPOLL_TIMEOUT)
+        except defer.TimeoutError:
+            pass # nothing changed for a long time; just get the current template
+        else:
+            latency = None # time spent waiting isn't latency
+    if work is None:
         try:
             start = time.time()
             work = yield go()
-            end = time.time()
+            latency = time.time() - start
         except jsonrpc.Error_for_code(-32601): # Method not found
-            print >>sys.stderr, 'Error: Bitcoin version too old! Upgrade to v0.5 or newer!'
-            raise deferral.RetrySilentlyException()
+            use_getblocktemplate = not use_getblocktemplate
+            try:
+                start = time.time()
+                work = yield go()
+                latency = time.time() - start
+            except jsonrpc.Error_for_code(-32601): # Method not found
+                print >>sys.stderr, 'Error: Bitcoin version too old! Upgrade to v0.5 or newer!'
+                raise deferral.RetrySilentlyException()
     packed_transactions = [(x['data'] if isinstance(x, dict) else x).decode('hex') for x in work['transactions']]
+    transaction_hashes = map(bitcoin_data.hash256, packed_transactions)
+    previous_txs = dict(zip(previous_template['transaction_hashes'], previous_template['transactions'])) if previous_template is not None else {}
     if 'height' not in work:
         work['height'] = (yield bitcoind.rpc_getblock(work['previousblockhash']))['height'] + 1
     elif p2pool.DEBUG:
         assert work['height'] == (yield bitcoind.rpc_getblock(work['previousblockhash']))['height'] + 1
-    defer.returnValue(dict(
+    defer.returnValue((BlockTemplate(
         version=work['version'],
         previous_block=int(work['previousblockhash'], 16),
-        transactions=map(bitcoin_data.tx_type.unpack, packed_transactions),
-        transaction_hashes=map(bitcoin_data.hash256, packed_transactions),
+        transactions=[previous_txs[tx_hash] if tx_hash in previous_txs else bitcoin_data.tx_type.unpack(packed_tx)
+            for tx_hash, packed_tx in zip(transaction_hashes, packed_transactions)],
+        transaction_hashes=transaction_hashes,
         subsidy=work['coinbasevalue'],
-        time=work['time'] if 'time' in work else work['curtime'],
         bits=bitcoin_data.FloatingIntegerType().unpack(work['bits'].decode('hex')[::-1]) if isinstance(work['bits'], (str, unicode)) else bitcoin_data.FloatingInteger(work['bits']),
         coinbaseflags=work['coinbaseflags'].decode('hex') if 'coinbaseflags' in work else ''.join(x.decode('hex') for x in work['coinbaseaux'].itervalues()) if 'coinbaseaux' in work else '',
         height=work['height'],
-        last_update=time.time(),
         use_getblocktemplate=use_getblocktemplate,
-        latency=end - start,
-    ))
-
-@deferral.retry('Error submitting primary block: (will retry)', 10, 10)
-def submit_block_p2p(block, factory, net):
-    if factory.conn.value is None:
-        print >>sys.stderr, 'No bitcoind connection when block submittal attempted! %s%064x' % (net.PARENT.BLOCK_EXPLORER_URL_PREFIX, bitcoin_data.hash256(bitcoin_data.block_header_type.pack(block['header'])))
-        raise deferral.RetrySilentlyException()
-    factory.conn.value.send_block(block=block)
-
-@deferral.retry('Error submitting block: (will retry)', 10, 10)
-@defer.inlineCallbacks
-def submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net):
-    if bitcoind_work.value['use_getblocktemplate']:
-        result = yield bitcoind.rpc_submitblock(bitcoin_data.block_type.pack(block).encode('hex'))
-        success = result is None
-    else:
-        result = yield bitcoind.rpc_getmemorypool(bitcoin_data.block_type.pack(block).encode('hex'))
-        success = result
-    success_expected = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(block['header'])) <= block['header']['bits'].target
-    if (not success and success_expected and not ignore_failure) or (success and not success_expected):
-        print >>sys.stderr, 'Block submittal result: %s (%r) Expected: %s' % (success, result, success_expected)
+    ), dict(
+        time=work['time'] if 'time' in work else work['curtime'],
+        last_update=time.time(),
+        latency=latency,
+        longpollid=work.get('longpollid', None),
+    )))
 
-def submit_block(block, ignore_failure, factory, bitcoind, bitcoind_work, net):
-    submit_block_p2p(block, factory, net)
-    submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net)
+class BlockSubmitter(object):
+    '''
+    Passes found blocks to bitcoind over P2P and RPC at the same time. Each
+    block is packed once, blocks that were already submitted (e.g. one of our
+    own shares coming back from the tracker) are ignored, and the RPC call is
+    sent ahead of any other calls to bitcoind. The most recent max_blocks
+    submissions are kept for get_stats.
+    '''
+    
+    def __init__(self, factory, bitcoind, bitcoind_work, net, max_blocks=100):
+        self.factory = factory
+        self.bitcoind = bitcoind
+        self.bitcoind_work = bitcoind_work
+        self.net = net
+        self.max_blocks = max_blocks
+        
+        self.submissions = collections.OrderedDict() # header hash -> submission stats, oldest first
+        self.duplicates = 0
+    
+    def submit(self, block, ignore_failure):
+        '''
+        Returns False if the block was already submitted.
+        '''
+        
+        packed_header = bitcoin_data.block_header_type.pack(block['header'])
+        header_hash = bitcoin_data.hash256(packed_header)
+        if header_hash in self.submissions:
+            self.duplicates += 1
+            return False
+        
+        packed = bitcoin_data.block_type.pack(block)
+        submission = dict(
+            time=time.time(),
+            size=len(packed),
+            p2p_latency=None,
+            rpc_latency=None,
+            rpc_attempts=0,
+            rpc_success=None,
+        )
+        self.submissions[header_hash] = submission
+        while len(self.submissions) > self.max_blocks:
+            self.submissions.popitem(last=False)
+        
+        success_expected = self.net.PARENT.POW_FUNC(packed_header) <= block['header']['bits'].target
+        self._submit_p2p(packed, header_hash, submission)
+        self._submit_rpc(packed.encode('hex'), success_expected, ignore_failure, submission)
+        return True
+    
+    @deferral.retry('Error submitting primary block: (will retry)', 10, 10)
+    def _submit_p2p(self, packed, header_hash, submission):
+        if self.factory.conn.value is None:
+            print >>sys.stderr, 'No bitcoind connection when block submittal attempted! %s%064x' % (self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)
+            raise deferral.RetrySilentlyException()
+        self.factory.conn.value.sendPayload('block', packed)
+        submission['p2p_latency'] = time.time() - submission['time']
+    
+    @deferral.retry('Error submitting block: (will retry)', 10, 10)
+    @defer.inlineCallbacks
+    def _submit_rpc(self, packed_hex, success_expected, ignore_failure, submission):
+        submission['rpc_attempts'] += 1
+        if self.bitcoind_work.value['use_getblocktemplate']:
+            result = yield self.bitcoind.callRemote('submitblock', packed_hex, priority=True)
+            success = result is None
+        else:
+            result = yield self.bitcoind.callRemote('getmemorypool', packed_hex, priority=True)
+            success = result
+        submission['rpc_latency'] = time.time() - submission['time']
+        submission['rpc_success'] = bool(success)
+        if (not success and success_expected and not ignore_failure) or (success and not success_expected):
+            print >>sys.stderr, 'Block submittal result: %s (%r) Expected: %s' % (success, result, success_expected)
+    
+    def get_stats(self):
+        return dict(
+            duplicates=self.duplicates,
+            submissions=dict(('%064x' % (header_hash,), submission) for header_hash, submission in self.submissions.iteritems()),
+        )
@@ -1,11 +1,15 @@
 from __future__ import division
 
 import StringIO
+import base64
+import binascii
 import json
 import random
 import sys
 
-from twisted.internet import defer
+from twisted.internet import defer, protocol
+from twisted.protocols import policies
+from twisted.python import log
 
 import p2pool
 from p2pool.bitcoin import getwork
@@ -24,6 +28,184 @@ class _GETableServer(jsonrpc.Server):
         jsonrpc.Server.__init__(self, provider)
         self.render_GET = render_get_func
 
+class _Request(object):
+    '''
+    The parts of twisted.web's Request that WorkerInterface and WorkerBridge
+    use, for requests handled by _WorkerChannel
+    '''
+    
+    def __init__(self, channel, headers):
+        self.channel = channel
+        self.headers = headers # lowercased name -> value
+        self.response_headers = []
+    
+    def getHeader(self, key):
+        return self.headers.get(key.lower(), None)
+    
+    def setHeader(self, key, value):
+        self.response_headers.append((key, value))
+    
+    def getUser(self):
+        return self.channel.get_auth(self.headers.get('authorization', None))[0]
+    
+    def getPassword(self):
+        return self.channel.get_auth(self.headers.get('authorization', None))[1]
+    
+    def getClientIP(self):
+        return self.channel.transport.getPeer().host
+
+_FAST_PATHS = set([('POST', '/'), ('POST', '/long-polling'), ('GET', '/long-polling')])
+
+class _WorkerChannel(protocol.Protocol, policies.TimeoutMixin):
+    '''
+    HTTP/1.1 connection that answers getwork and long polling requests
+    itself, one at a time in order. Once any other request arrives, the
+    connection is handed over to the factory's site for good. Like the site's
+    own channels, it is closed after the site's timeOut without a request.
+    '''
+    
+    max_header_size = 2**16
+    max_body_size = 2**20
+    
+    def connectionMade(self):
+        self.buffer = ''
+        self.busy = False
+        self.processing = False
+        self.disconnected = False
+        self.web_channel = None
+        self.auth = None, '', '' # Authorization header, user, password
+        self.setTimeout(self.factory.site.timeOut)
+    
+    def dataReceived(self, data):
+        if self.web_channel is not None:
+            self.web_channel.dataReceived(data)
+            return
+        self.resetTimeout()
+        self.buffer += data
+        self._process()
+    
+    def connectionLost(self, reason):
+        self.disconnected = True
+        self.setTimeout(None)
+        if self.web_channel is not None:
+            self.web_channel.connectionLost(reason)
+    
+    def get_auth(self, authorization):
+        # parsed like twisted.web's Request._authorize, but only once per connection
+        if authorization != self.auth[0]:
+            try:
+                scheme, user_password = authorization.split()
+                if scheme.lower() != 'basic':
+                    raise ValueError()
+                user, password = base64.decodestring(user_password).split(':', 1)
+            except (AttributeError, binascii.Error, ValueError):
+                user = password = ''
+            self.auth = authorization, user, password
+        return self.auth[1:]
+    
+    def _process(self):
+        if self.processing: # a response was sent synchronously from within the loop below, which will carry on
+            return
+        self.processing = True
+        try:
+            self._process_requests()
+        finally:
+            self.processing = False
+    
+    def _process_requests(self):
+        while not self.busy and self.web_channel is None and not self.disconnected:
+            head_end = self.buffer.find('\r\n\r\n')
+            if head_end == -1:
+                if len(self.buffer) > self.max_header_size:
+                    self.transport.loseConnection()
+                return
+            
+            lines = self.buffer[:head_end].split('\r\n')
+            request_line = lines[0].split(' ')
+            if len(request_line) != 3 or (request_line[0], request_line[1]) not in _FAST_PATHS:
+                self._hand_over()
+                return
+            method, path, version = request_line
+            
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if 'transfer-encoding' in headers or 'expect' in headers: # chunked bodies and 100-continue are left to twisted.web
+                self._hand_over()
+                return
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+            if not 0 <= length <= self.max_body_size:
+                self.transport.loseConnection()
+                return
+            
+            if len(self.buffer) < head_end + 4 + length:
+                return # wait for the rest of the body
+            body = self.buffer[head_end + 4:head_end + 4 + length]
+            self.buffer = self.buffer[head_end + 4 + length:]
+            
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+            
+            self.busy = True
+            self.setTimeout(None) # long polls can take longer than the timeout
+            self.factory.requests += 1
+            request = _Request(self, headers)
+            if method == 'GET':
+                body = json.dumps(dict(id=0, method='getwork'))
+            self.factory.servers[path].handle_data(request, body).addCallbacks(
+                lambda data, request=request, keep_alive=keep_alive: self._respond(request, '200 OK', 'application/json', data, keep_alive),
+                self._respond_error,
+            )
+    
+    def _respond(self, request, status, content_type, data, keep_alive):
+        if self.disconnected:
+            return
+        self.transport.write(''.join(
+            ['HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %i\r\n' % (status, content_type, len(data))] +
+            ['%s: %s\r\n' % (key, value) for key, value in request.response_headers] +
+            ['\r\n' if keep_alive else 'Connection: close\r\n\r\n', data]
+        ))
+        if not keep_alive:
+            self.transport.loseConnection()
+            return
+        self.busy = False
+        self.setTimeout(self.factory.site.timeOut)
+        self._process()
+    
+    def _respond_error(self, fail):
+        log.err(fail, 'Error in _WorkerChannel handler:')
+        self._respond(_Request(self, {}), '500 Internal Server Error', 'text/html', '---ERROR---', False)
+    
+    def _hand_over(self):
+        self.factory.handed_over += 1
+        self.setTimeout(None) # the site's channel times out on its own
+        self.web_channel = self.factory.site.buildProtocol(self.transport.getPeer())
+        self.web_channel.makeConnection(self.transport)
+        data, self.buffer = self.buffer, ''
+        self.web_channel.dataReceived(data)
+
+class WorkerServerFactory(protocol.ServerFactory):
+    '''
+    Serves getwork and long polling for worker_interface directly, without
+    going through twisted.web, and passes connections making any other
+    request on to site, which should have worker_interface attached too.
+    '''
+    
+    protocol = _WorkerChannel
+    
+    def __init__(self, worker_interface, site):
+        self.site = site
+        self.servers = {
+            '/': jsonrpc.Server(_Provider(worker_interface, long_poll=False)),
+            '/long-polling': jsonrpc.Server(_Provider(worker_interface, long_poll=True)),
+        }
+        self.requests = 0
+        self.handed_over = 0
+
 class WorkerBridge(object):
     def __init__(self):
         self.new_work_event = variable.Event()
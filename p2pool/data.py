@@ -55,6 +55,43 @@ def load_share(share, net, peer):
     else:
         raise ValueError('unknown share type: %r' % (share['type'],))
 
+def get_packed_share(share):
+    '''
+    Returns share_type.pack(share.as_share()), packed once per share and kept
+    in share.packed since shares are sent to every peer and written to disk
+    '''
+    
+    if share.packed is None:
+        share.packed = share_type.pack(share.as_share())
+    return share.packed
+
+def get_share_tx_hashes_by_share(tracker, shares):
+    '''
+    Returns {share hash: set of hashes of the transactions it references} for
+    shares, which may build on each other and on shares in tracker, without
+    adding them to tracker. References that can't be resolved yet are skipped.
+    '''
+    by_hash = dict((share.hash, share) for share in shares)
+    res = {}
+    for share in shares:
+        tx_hashes = res[share.hash] = set()
+        for ref in share.share_info.get('transaction_hash_refs', []):
+            share_hash, n = share.hash, ref['share_count']
+            while n and share_hash in by_hash:
+                share_hash, n = by_hash[share_hash].previous_hash, n - 1
+            if share_hash in by_hash:
+                ref_share = by_hash[share_hash]
+            elif share_hash in tracker.items and tracker.get_height(share_hash) > n:
+                ref_share = tracker.items[tracker.get_nth_parent_hash(share_hash, n)]
+            else:
+                continue
+            if ref['tx_count'] < len(ref_share.new_transaction_hashes):
+                tx_hashes.add(ref_share.new_transaction_hashes[ref['tx_count']])
+    return res
+
+def get_share_tx_hashes(tracker, shares):
+    return set().union(*get_share_tx_hashes_by_share(tracker, shares).itervalues())
+
 DONATION_SCRIPT = '4104ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664bac'.decode('hex')
 
 class NewNewShare(object):
@@ -215,11 +252,12 @@ class NewNewShare(object):
             share_info=share_info,
         ))), ref_merkle_link))
     
-    __slots__ = 'net peer contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen'.split(' ')
+    __slots__ = 'net peer contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen packed'.split(' ')
     
     def __init__(self, net, peer, contents):
         self.net = net
         self.peer = peer
+        self.packed = None
         self.contents = contents
         
         self.min_header = contents['min_header']
@@ -489,11 +527,12 @@ class Share(object):
             share_info=share_info,
         ))), ref_merkle_link))
     
-    __slots__ = 'net peer common min_header share_info hash_link merkle_link other_txs hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen'.split(' ')
+    __slots__ = 'net peer common min_header share_info hash_link merkle_link other_txs hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen packed'.split(' ')
     
     def __init__(self, net, peer, common, merkle_link, other_txs):
         self.net = net
         self.peer = peer
+        self.packed = None
         self.common = common
         self.min_header = common['min_header']
         self.share_info = common['share_info']
@@ -758,11 +797,12 @@ class NewShare(object):
             share_info=share_info,
         ))), ref_merkle_link))
     
-    __slots__ = 'net peer contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen'.split(' ')
+    __slots__ = 'net peer contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen packed'.split(' ')
     
     def __init__(self, net, peer, contents):
         self.net = net
         self.peer = peer
+        self.packed = None
         self.contents = contents
         
         self.min_header = contents['min_header']
@@ -945,6 +985,12 @@ class OkayTracker(forest.Tracker):
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
         )), subset_of=self)
         self.get_cumulative_weights = WeightsSkipList(self)
+        self.stats_view = forest.TrackerView(self, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
+            stale_count=lambda share: 1 if share.share_data['stale_info'] is not None else 0,
+            stale_works=lambda share: math.SumDict({share.share_data['stale_info']: bitcoin_data.target_to_average_attempts(share.target)} if share.share_data['stale_info'] is not None else {}),
+            desired_version_works=lambda share: math.SumDict({share.desired_version: bitcoin_data.target_to_average_attempts(share.target)}),
+        )))
     
     def attempt_verify(self, share):
         if share.hash in self.verified.items:
@@ -1080,23 +1126,26 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
         return attempts//time
     return attempts/time
 
+def get_chain_stats(tracker, share_hash, length):
+    # totals over the same shares as tracker.get_chain(share_hash, length), from two prefix-sum lookups
+    return tracker.stats_view.get_delta(share_hash, tracker.get_nth_parent_hash(share_hash, length))
+
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    stales = get_chain_stats(tracker, share_hash, lookbehind).stale_count
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    stats = get_chain_stats(tracker, share_hash, lookbehind - 1)
+    res = dict(stats.stale_works)
+    if stats.work:
+        res['good'] = stats.work
     if rates:
         dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
         res = dict((k, v/dt) for k, v in res.iteritems())
     return res
 
 def get_user_stale_props(tracker, share_hash, lookbehind):
+    # per-user totals aren't kept in stats_view, as that would store a dict of every user for each share
     res = {}
     for share in tracker.get_chain(share_hash, lookbehind - 1):
         stale, total = res.get(share.share_data['pubkey_hash'], (0, 0))
@@ -1114,12 +1163,9 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
-    return res
+    return dict(get_chain_stats(tracker, best_share_hash, dist).desired_version_works)
 
-def get_warnings(tracker, best_share, net, bitcoind_warning, bitcoind_work_value):
+def get_warnings(tracker, best_share, net, bitcoind_warning, bitcoind_work_freshness_value):
     res = []
     
     desired_version_counts = get_desired_version_counts(tracker, best_share,
@@ -1134,8 +1180,8 @@ def get_warnings(tracker, best_share, net, bitcoind_warning, bitcoind_work_value
         if 'This is a pre-release test build' not in bitcoind_warning:
             res.append('(from bitcoind) %s' % (bitcoind_warning,))
     
-    if time.time() > bitcoind_work_value['last_update'] + 60:
-        res.append('''LOST CONTACT WITH BITCOIND for %s! Check that it isn't frozen or dead!''' % (math.format_dt(time.time() - bitcoind_work_value['last_update']),))
+    if time.time() > bitcoind_work_freshness_value['last_update'] + 60:
+        res.append('''LOST CONTACT WITH BITCOIND for %s! Check that it isn't frozen or dead!''' % (math.format_dt(time.time() - bitcoind_work_freshness_value['last_update']),))
     
     return res
 
@@ -1204,7 +1250,7 @@ class ShareStore(object):
             if share.hash in share_hashes:
                 break
         else:
-            filename = self._add_line("%i %s" % (5, share_type.pack(share.as_share()).encode('hex')))
+            filename = self._add_line("%i %s" % (5, get_packed_share(share).encode('hex')))
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             share_hashes.add(share.hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
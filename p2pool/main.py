@@ -47,9 +47,9 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         # connect to bitcoind over JSON-RPC and do initial getmemorypool
         url = '%s://%s:%i/' % ('https' if args.bitcoind_rpc_ssl else 'http', args.bitcoind_address, args.bitcoind_rpc_port)
         print '''Testing bitcoind RPC connection to '%s' with username '%s'...''' % (url, args.bitcoind_rpc_username)
-        bitcoind = jsonrpc.Proxy(url, dict(Authorization='Basic ' + base64.b64encode(args.bitcoind_rpc_username + ':' + args.bitcoind_rpc_password)), timeout=30)
+        bitcoind = jsonrpc.Proxy(url, dict(Authorization='Basic ' + base64.b64encode(args.bitcoind_rpc_username + ':' + args.bitcoind_rpc_password)), timeout=30, persistent_connections=args.bitcoind_rpc_conns)
         yield helper.check(bitcoind, net)
-        temp_work = yield helper.getwork(bitcoind)
+        temp_work, _ = yield helper.getwork(bitcoind)
         
         bitcoind_warning_var = variable.Variable(None)
         @defer.inlineCallbacks
@@ -117,7 +117,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         
         print 'Initializing work...'
         
-        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net)
+        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net, max_tx_pool_size=int(args.max_tx_pool_size*1e6), block_headers_path=os.path.join(datadir_path, 'block_headers'), block_heights_path=os.path.join(datadir_path, 'block_heights'))
         yield node.start()
         
         for share_hash in shares:
@@ -213,9 +213,10 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         
         wb = work.WorkerBridge(node, my_pubkey_hash, args.donation_percentage, merged_urls, args.worker_fee)
         web_root = web.get_web_root(wb, datadir_path, bitcoind_warning_var)
-        worker_interface.WorkerInterface(wb).attach_to(web_root, get_handler=lambda request: request.redirect('/static/'))
+        wi = worker_interface.WorkerInterface(wb)
+        wi.attach_to(web_root, get_handler=lambda request: request.redirect('/static/'))
         
-        deferral.retry('Error binding to worker port:', traceback=False)(reactor.listenTCP)(worker_endpoint[1], server.Site(web_root), interface=worker_endpoint[0])
+        deferral.retry('Error binding to worker port:', traceback=False)(reactor.listenTCP)(worker_endpoint[1], worker_interface.WorkerServerFactory(wi, server.Site(web_root)), interface=worker_endpoint[0])
         
         with open(os.path.join(os.path.join(datadir_path, 'ready_flag')), 'wb') as f:
             pass
@@ -330,7 +331,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
                             math.format_dt(2**256 / node.bitcoind_work.value['bits'].target / real_att_s),
                         )
                         
-                        for warning in p2pool_data.get_warnings(node.tracker, node.best_share_var.value, net, bitcoind_warning_var.value, node.bitcoind_work.value):
+                        for warning in p2pool_data.get_warnings(node.tracker, node.best_share_var.value, net, bitcoind_warning_var.value, node.bitcoind_work_freshness.value):
                             print >>sys.stderr, '#'*40
                             print >>sys.stderr, '>>> Warning: ' + warning
                             print >>sys.stderr, '#'*40
@@ -401,6 +402,9 @@ def run():
     p2pool_group.add_argument('--outgoing-conns', metavar='CONNS',
         help='outgoing connections (default: 10)',
         type=int, action='store', default=10, dest='p2pool_outgoing_conns')
+    p2pool_group.add_argument('--max-tx-pool-size', metavar='MEGABYTES',
+        help='besides every 10 seconds, forget transactions not needed by the current work, peers or recent shares as soon as known transactions take up more than this (default: 50)',
+        type=float, action='store', default=50, dest='max_tx_pool_size')
     
     worker_group = parser.add_argument_group('worker interface')
     worker_group.add_argument('-w', '--worker-port', metavar='PORT or ADDR:PORT',
@@ -420,6 +424,9 @@ def run():
     bitcoind_group.add_argument('--bitcoind-rpc-ssl',
         help='connect to JSON-RPC interface using SSL',
         action='store_true', default=False, dest='bitcoind_rpc_ssl')
+    bitcoind_group.add_argument('--bitcoind-rpc-conns', metavar='CONNS',
+        help='keep up to this many idle connections to the JSON-RPC interface open for reuse (default: 2)',
+        type=int, action='store', default=2, dest='bitcoind_rpc_conns')
     bitcoind_group.add_argument('--bitcoind-p2p-port', metavar='BITCOIND_P2P_PORT',
         help='''connect to P2P interface at this port (default: %s <read from bitcoin.conf if password not provided>)''' % ', '.join('%s:%i' % (name, net.PARENT.P2P_PORT) for name, net in sorted(realnets.items())),
         type=int, action='store', default=None, dest='bitcoind_p2p_port')
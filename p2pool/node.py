@@ -2,7 +2,7 @@ import random
 import sys
 import time
 
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, error, reactor, task
 from twisted.python import log
 
 from p2pool import data as p2pool_data, p2p
@@ -70,6 +70,14 @@ class P2PNode(p2p.Node):
         print 'Sending %i shares to %s:%i' % (len(shares), peer.addr[0], peer.addr[1])
         return shares
     
+    def handle_get_share_hashes(self, share_hash, count, peer):
+        if share_hash not in self.node.tracker.items:
+            return []
+        return [share.hash for share in self.node.tracker.get_chain(share_hash, min(count, self.node.tracker.get_height(share_hash)))]
+    
+    def get_share_tx_hashes_by_share(self, shares):
+        return p2pool_data.get_share_tx_hashes_by_share(self.node.tracker, shares)
+    
     def handle_bestblock(self, header, peer):
         if self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header)) > header['bits'].target:
             raise p2p.PeerMisbehavingError('received block header fails PoW test')
@@ -84,8 +92,96 @@ class P2PNode(p2p.Node):
             self.shared_share_hashes.add(share.hash)
             shares.append(share)
         
+        if not shares:
+            return
+        
+        # block solutions jump ahead of whatever is still queued for each peer
+        priority = 0 if any(share.pow_hash <= share.header['bits'].target for share in shares) else 1
+        dfs = []
         for peer in list(self.peers.itervalues()):
-            yield peer.sendShares([share for share in shares if share.peer is not peer], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash])
+            peer_shares = [share for share in shares if share.peer is not peer]
+            if peer_shares:
+                dfs.append(peer.queueShares(peer_shares, self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash], priority=priority))
+        for success, result in (yield defer.DeferredList(dfs, consumeErrors=True)):
+            if not success and not result.check(error.ConnectionDone, error.ConnectionLost):
+                log.err(result, 'Error while broadcasting share:')
+    
+    @defer.inlineCallbacks
+    def download_chain(self, share_hash, hashes_peer, peers):
+        '''
+        Downloads share_hash and its ancestors that aren't in the tracker yet:
+        first just their hashes from hashes_peer, then disjoint ranges of them
+        from all of peers at once, each peer asking for as many shares at a time
+        as it has recently been able to deliver. A range a peer fails to deliver
+        goes back to the others, so the download only ends once every range is
+        done or every peer has given up. Returns the number of shares received.
+        '''
+        try:
+            hashes = yield hashes_peer.get_share_hashes(hash=share_hash, count=self.node.net.CHAIN_LENGTH)
+        except:
+            log.err(None, 'in download_chain:')
+            defer.returnValue(0)
+        for i, x in enumerate(hashes):
+            if x in self.node.tracker.items:
+                hashes = hashes[:i]
+                break
+        if not hashes:
+            defer.returnValue(0)
+        
+        print 'Downloading %i shares from %i peers...' % (len(hashes), len(peers))
+        pending = [(0, len(hashes))] # [start, end) ranges of hashes nobody is working on
+        in_flight = [0] # ranges being requested, any of which may be put back on pending
+        request_done = variable.Event()
+        counts = {}
+        
+        @defer.inlineCallbacks
+        def worker(peer):
+            failures = 0
+            while failures < 3 and peer.connected2:
+                if not pending:
+                    if not in_flight[0]:
+                        break
+                    yield request_done.get_deferred()
+                    continue
+                start, end = pending.pop(0)
+                if end - start > peer.download_batch_size:
+                    pending.insert(0, (start + peer.download_batch_size, end))
+                    end = start + peer.download_batch_size
+                
+                request_time = reactor.seconds()
+                in_flight[0] += 1
+                try:
+                    shares = yield peer.get_shares(
+                        hashes=[hashes[start]],
+                        parents=end - start - 1,
+                        stops=[],
+                    )
+                except:
+                    pending.append((start, end))
+                    in_flight[0] -= 1
+                    request_done.happened()
+                    peer.record_download_failure()
+                    failures += 1
+                    continue
+                
+                got = 0
+                for share, share_hash in zip(shares, hashes[start:end]):
+                    if share.hash != share_hash:
+                        break
+                    got += 1
+                if got < end - start:
+                    pending.append((start + got, end)) # let another peer finish the range
+                in_flight[0] -= 1
+                request_done.happened()
+                if not got:
+                    break # peer doesn't have this chain
+                peer.record_download(got, reactor.seconds() - request_time)
+                counts[peer] = counts.get(peer, 0) + got
+                self.handle_shares(shares[:got], peer)
+        
+        yield defer.DeferredList([worker(peer) for peer in peers])
+        print '... downloaded %i shares (%s)' % (sum(counts.itervalues()), ', '.join('%s:%i %i at %.1f/s' % (peer.addr[0], peer.addr[1], count, peer.download_rate) for peer, count in counts.iteritems()))
+        defer.returnValue(sum(counts.itervalues()))
     
     def start(self):
         p2p.Node.start(self)
@@ -103,6 +199,16 @@ class P2PNode(p2p.Node):
                 if len(self.peers) == 0:
                     yield deferral.sleep(1)
                     continue
+                
+                sync_peers = [peer for peer in self.peers.itervalues() if peer.other_version >= 11]
+                if sync_peers:
+                    # only sync peers can list the chain's hashes, but any peer can serve ranges of it
+                    count = yield self.download_chain(share_hash, peer2 if peer2 in sync_peers else random.choice(sync_peers), self.peers.values())
+                    if count:
+                        continue
+                    if not self.peers:
+                        continue
+                
                 peer = random.choice(self.peers.values())
                 
                 print 'Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr)
@@ -144,10 +250,13 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, max_tx_pool_size=50000000, block_headers_path=None, block_heights_path=None):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
+        self.max_tx_pool_size = max_tx_pool_size
+        self.block_headers_path = block_headers_path
+        self.block_heights_path = block_heights_path
         
         self.tracker = p2pool_data.OkayTracker(self.net)
         
@@ -167,17 +276,35 @@ class Node(object):
         
         # BITCOIND WORK
         
-        self.bitcoind_work = variable.Variable((yield helper.getwork(self.bitcoind)))
+        template, freshness = yield helper.getwork(self.bitcoind)
+        self.bitcoind_work = variable.Variable(template) # only changes when the block being mined does
+        self.bitcoind_work_freshness = variable.Variable(freshness) # time, last_update, latency and longpollid of the latest template
+        def set_work((template, freshness)):
+            if freshness['latency'] is None: # long poll; keep the last measured latency
+                freshness = dict(freshness, latency=self.bitcoind_work_freshness.value['latency'])
+            self.bitcoind_work_freshness.set(freshness)
+            self.bitcoind_work.set(template)
+        self.block_submitter = helper.BlockSubmitter(self.factory, self.bitcoind, self.bitcoind_work, self.net)
         @defer.inlineCallbacks
         def work_poller():
             while stop_signal.times == 0:
                 flag = self.factory.new_block.get_deferred()
                 try:
-                    self.bitcoind_work.set((yield helper.getwork(self.bitcoind, self.bitcoind_work.value['use_getblocktemplate'])))
+                    set_work((yield helper.getwork(self.bitcoind, self.bitcoind_work.value['use_getblocktemplate'], self.bitcoind_work.value)))
                 except:
                     log.err()
                 yield defer.DeferredList([flag, deferral.sleep(15)], fireOnOneCallback=True)
         work_poller()
+        @defer.inlineCallbacks
+        def work_longpoller():
+            # bitcoind answers as soon as its template changes, e.g. from a new block or new transactions
+            while stop_signal.times == 0 and self.bitcoind_work_freshness.value['longpollid'] is not None:
+                try:
+                    set_work((yield helper.getwork(self.bitcoind, True, self.bitcoind_work.value, self.bitcoind_work_freshness.value['longpollid'])))
+                except:
+                    log.err()
+                    yield deferral.sleep(1)
+        work_longpoller()
         
         # PEER WORK
         
@@ -208,42 +335,42 @@ class Node(object):
         
         # BEST SHARE
         
-        self.known_txs_var = variable.Variable({}) # hash -> tx
+        # hash -> tx; txs the mining template, a peer or a recent share refers to are kept, others are forgotten every 10 seconds or as soon as the pool passes max_tx_pool_size bytes
+        self.known_txs_var = variable.BoundedVariableDict({}, self.max_tx_pool_size, bitcoin_data.tx_type.packed_size)
         self.mining_txs_var = variable.Variable({}) # hash -> tx
-        self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net)
+        self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net, self.block_headers_path, self.block_heights_path)
+        self.tracker.added.watch(lambda share: self.get_height_rel_highest.prefetch([share.header['previous_block']]))
         
         self.best_share_var = variable.Variable(None)
         self.desired_var = variable.Variable(None)
         self.bitcoind_work.changed.watch(lambda _: self.set_best_share())
         self.set_best_share()
+        # heights for the blocks loaded shares build on are fetched in the background, then the shares are scored again
+        self.get_height_rel_highest.prefetch(share.header['previous_block'] for share in self.tracker.items.itervalues()).addCallback(lambda _: self.set_best_share())
         
         # setup p2p logic and join p2pool network
         
         # update mining_txs according to getwork results
         @self.bitcoind_work.changed.run_and_watch
         def _(_=None):
-            new_mining_txs = {}
-            new_known_txs = dict(self.known_txs_var.value)
-            for tx_hash, tx in zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']):
-                new_mining_txs[tx_hash] = tx
-                new_known_txs[tx_hash] = tx
+            new_mining_txs = dict(zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']))
             self.mining_txs_var.set(new_mining_txs)
-            self.known_txs_var.set(new_known_txs)
+            self.known_txs_var.set_refs_and_add('mining', new_mining_txs)
         # add p2p transactions from bitcoind to known_txs
         @self.factory.new_tx.watch
         def _(tx):
-            new_known_txs = dict(self.known_txs_var.value)
-            new_known_txs[bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))] = tx
-            self.known_txs_var.set(new_known_txs)
+            self.known_txs_var.add({
+                bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)): tx,
+            })
         # forward transactions seen to bitcoind
-        @self.known_txs_var.transitioned.watch
+        @self.known_txs_var.added.watch
         @defer.inlineCallbacks
-        def _(before, after):
+        def _(added):
             yield deferral.sleep(random.expovariate(1/1))
             if self.factory.conn.value is None:
                 return
-            for tx_hash in set(after) - set(before):
-                self.factory.conn.value.send_tx(tx=after[tx_hash])
+            for tx_hash in added:
+                self.factory.conn.value.send_tx(tx=added[tx_hash])
         
         @self.tracker.verified.added.watch
         def _(share):
@@ -254,22 +381,19 @@ class Node(object):
             if block is None:
                 print >>sys.stderr, 'GOT INCOMPLETE BLOCK FROM PEER! %s bitcoin: %s%064x' % (p2pool_data.format_hash(share.hash), self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, share.header_hash)
                 return
-            helper.submit_block(block, True, self.factory, self.bitcoind, self.bitcoind_work, self.net)
+            if not self.block_submitter.submit(block, True):
+                return
             print
             print 'GOT BLOCK FROM PEER! Passing to bitcoind! %s bitcoin: %s%064x' % (p2pool_data.format_hash(share.hash), self.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, share.header_hash)
             print
         
         def forget_old_txs():
-            new_known_txs = {}
-            if self.p2p_node is not None:
-                for peer in self.p2p_node.peers.itervalues():
-                    new_known_txs.update(peer.remembered_txs)
-            new_known_txs.update(self.mining_txs_var.value)
+            # refs from mining and peers are kept current as they change; only recent shares need refreshing
+            share_tx_hashes = set()
             for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
-                for tx_hash in share.new_transaction_hashes:
-                    if tx_hash in self.known_txs_var.value:
-                        new_known_txs[tx_hash] = self.known_txs_var.value[tx_hash]
-            self.known_txs_var.set(new_known_txs)
+                share_tx_hashes.update(share.new_transaction_hashes)
+            self.known_txs_var.set_refs('shares', share_tx_hashes)
+            self.known_txs_var.remove_unreferenced()
         t = task.LoopingCall(forget_old_txs)
         t.start(10)
         stop_signal.watch(t.stop)
@@ -1,11 +1,17 @@
 from __future__ import division
 
+import collections
+import hashlib
+import heapq
+import itertools
 import math
 import random
+import struct
 import sys
 import time
+import zlib
 
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, protocol, reactor, threads
 from twisted.python import failure, log
 
 import p2pool
@@ -16,6 +22,8 @@ from p2pool.util import deferral, p2protocol, pack, variable
 class PeerMisbehavingError(Exception):
     pass
 
+SERVICE_COMPRESSION = 1 << 0 # version message services flag: understands compressed messages
+
 
 def fragment(f, **kwargs):
     try:
@@ -24,8 +32,39 @@ def fragment(f, **kwargs):
         fragment(f, **dict((k, v[:len(v)//2]) for k, v in kwargs.iteritems()))
         return fragment(f, **dict((k, v[len(v)//2:]) for k, v in kwargs.iteritems()))
 
+varint_type = pack.VarIntType()
+
+def fragment_packed(items, max_length):
+    '''
+    Splits already packed ListType items into runs whose packed list fits in
+    max_length. Unlike fragment this decides by length alone, without
+    packing anything more than once.
+    '''
+    res = []
+    run, size = [], 0
+    for item in items:
+        if run and varint_type.packed_size(len(run) + 1) + size + len(item) > max_length:
+            res.append(run)
+            run, size = [], 0
+        run.append(item)
+        size += len(item)
+    if run:
+        res.append(run)
+    return res
+
+tx_hash_type = pack.IntType(256)
+short_tx_id_type = pack.IntType(48)
+
+def get_short_tx_id(salt, tx_hash):
+    # 48 bits keeps a false match against a full remote view (~1e4 ids) below 1e-10 per lookup
+    return struct.unpack('<Q', hashlib.sha256(salt + tx_hash_type.pack(tx_hash)).digest()[:8])[0] & (2**48 - 1)
+
 class Protocol(p2protocol.Protocol):
     max_remembered_txs_size = 2500000
+    max_remote_txs = 10000
+    tx_announce_delay = .5
+    compression_threshold = 10000 # payloads this big are sent compressed to peers that support it
+    thread_compression_threshold = 200000 # and compressed in a thread from this size on
     
     def __init__(self, node, incoming):
         p2protocol.Protocol.__init__(self, node.net.PREFIX, 1000000, node.traffic_happened)
@@ -33,7 +72,9 @@ class Protocol(p2protocol.Protocol):
         self.incoming = incoming
         
         self.other_version = None
+        self.other_services = 0
         self.connected2 = False
+        self.send_backlog = None # messages waiting behind one being compressed in a thread
     
     def connectionMade(self):
         p2protocol.Protocol.connectionMade(self)
@@ -45,8 +86,8 @@ class Protocol(p2protocol.Protocol):
         self.addr = self.transport.getPeer().host, self.transport.getPeer().port
         
         self.send_version(
-            version=8,
-            services=0,
+            version=11,
+            services=SERVICE_COMPRESSION,
             addr_to=dict(
                 services=0,
                 address=self.transport.getPeer().host,
@@ -71,13 +112,74 @@ class Protocol(p2protocol.Protocol):
             timeout=15,
             on_timeout=self.transport.loseConnection,
         )
+        self.get_share_hashes = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, hash, count: self.send_chainreq(id=id, hash=hash, count=count),
+            timeout=15,
+            on_timeout=self.transport.loseConnection,
+        )
+        self.get_txs = deferral.GenericDeferrer(
+            max_id=2**256,
+            func=lambda id, tx_hashes: self.send_gettxs(id=id, tx_hashes=tx_hashes),
+            timeout=15,
+            on_timeout=self.transport.loseConnection,
+        )
         
-        self.remote_tx_hashes = set() # view of peer's known_txs # not actually initially empty, but sending txs instead of tx hashes won't hurt
+        self.remote_tx_hashes = collections.OrderedDict() # view of peer's known_txs, oldest first # not actually initially empty, but sending txs instead of tx hashes won't hurt
+        self.remote_tx_short_ids = collections.OrderedDict() # same, for txs the peer announced by short id
         self.remote_remembered_txs_size = 0
         
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        
+        self.pending_have_tx = set() # announcements of my known_txs not sent yet
+        self.pending_losing_tx = set()
+        self.announce_delayed = None
+        self.announced_short_ids = {} # short id -> tx_hash, for txs announced to the peer by short id
+        
+        self.share_queue = [] # heap of (priority, seq, time queued, sendShares args, deferred)
+        self.share_queue_seq = itertools.count()
+        self.share_queue_running = False
+        self.share_latencies = collections.deque(maxlen=100) # seconds from queueing shares until the peer accepted them
+        self.incoming_shares = defer.succeed(None) # compact shares being handled, one message at a time
+        
+        self.download_batch_size = 50 # shares requested at once while syncing, adapted to how fast the peer answers
+        self.download_rate = None # shares/second, moving average
+    
+    def sendPayload(self, command, payload):
+        compress = self.other_services & SERVICE_COMPRESSION and len(payload) >= self.compression_threshold
+        if len(payload) > self._max_payload_length:
+            raise p2protocol.TooLong('payload too long')
+        if self.send_backlog is None and not (compress and len(payload) >= self.thread_compression_threshold):
+            return self._send_maybe_compressed(command, payload, zlib.compress(payload) if compress else None)
+        
+        # compress in a thread, holding back later messages so they stay in order
+        df = defer.Deferred()
+        if self.send_backlog is None:
+            self.send_backlog = [(command, payload, compress, df)]
+            self._process_send_backlog()
+        else:
+            self.send_backlog.append((command, payload, compress, df))
+        return df
+    
+    @defer.inlineCallbacks
+    def _process_send_backlog(self):
+        while self.send_backlog:
+            command, payload, compress, df = self.send_backlog.pop(0)
+            try:
+                compressed = (yield threads.deferToThread(zlib.compress, payload)) if compress else None
+                res = self._send_maybe_compressed(command, payload, compressed)
+            except:
+                df.errback(failure.Failure())
+            else:
+                res.chainDeferred(df)
+        self.send_backlog = None
+    
+    def _send_maybe_compressed(self, command, payload, compressed):
+        if compressed is not None and len(compressed) < len(payload):
+            return p2protocol.Protocol.sendPayload(self, 'compressed', self.message_compressed.pack(dict(command=command, payload=compressed)))
+        return p2protocol.Protocol.sendPayload(self, command, payload)
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -136,6 +238,10 @@ class Protocol(p2protocol.Protocol):
         self.nonce = nonce
         self.connected2 = True
         
+        # short ids are salted per connection and direction so colliding txs can't be crafted in advance
+        self.my_tx_salt = struct.pack('<QQ', self.node.nonce, self.nonce)
+        self.remote_tx_salt = struct.pack('<QQ', self.nonce, self.node.nonce)
+        
         self.timeout_delayed.cancel()
         self.timeout_delayed = reactor.callLater(100, self._timeout)
         
@@ -162,22 +268,32 @@ class Protocol(p2protocol.Protocol):
         if self.other_version < 8:
             return
         
-        def update_remote_view_of_my_known_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
-            if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
-                
-                # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
-                key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
-                reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id))
-        
-        self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
+        def added_known_txs(added):
+            for tx_hash in added:
+                if tx_hash in self.pending_losing_tx:
+                    self.pending_losing_tx.remove(tx_hash)
+                else:
+                    self.pending_have_tx.add(tx_hash)
+            self._schedule_tx_announcements()
+        def removed_known_txs(removed):
+            for tx_hash in removed:
+                if tx_hash in self.pending_have_tx:
+                    self.pending_have_tx.remove(tx_hash)
+                else:
+                    self.pending_losing_tx.add(tx_hash)
+            self._schedule_tx_announcements()
+            
+            # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
+            key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
+            self.known_txs_cache[key] = removed
+            reactor.callLater(20, self.known_txs_cache.pop, key)
+        watch_id = self.node.known_txs_var.added.watch(added_known_txs)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.added.unwatch(watch_id))
+        watch_id1 = self.node.known_txs_var.removed.watch(removed_known_txs)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.removed.unwatch(watch_id1))
+        
+        self.pending_have_tx.update(self.node.known_txs_var.value)
+        self._send_tx_announcements()
         
         def update_remote_view_of_my_mining_txs(before, after):
             added = set(after) - set(before)
@@ -185,7 +301,7 @@ class Protocol(p2protocol.Protocol):
             if added:
                 self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
                 assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
+                fragment(self.send_remember_tx, tx_hashes=[x for x in added if self.remote_has_tx(x)], txs=[after[x] for x in added if not self.remote_has_tx(x)])
             if removed:
                 self.send_forget_tx(tx_hashes=list(removed))
                 self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
@@ -196,6 +312,20 @@ class Protocol(p2protocol.Protocol):
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
         fragment(self.send_remember_tx, tx_hashes=[], txs=self.node.mining_txs_var.value.values())
     
+    message_compressed = pack.ComposedType([
+        ('command', pack.VarStrType()),
+        ('payload', pack.VarStrType()), # zlib compressed
+    ])
+    def handle_compressed(self, command, payload):
+        type_ = getattr(self, 'message_' + command, None)
+        if type_ is None or command == 'compressed':
+            raise PeerMisbehavingError('invalid command in compressed message')
+        decompressor = zlib.decompressobj()
+        payload = decompressor.decompress(payload, self._max_payload_length)
+        if decompressor.unconsumed_tail:
+            raise PeerMisbehavingError('compressed payload too long')
+        self.packetReceived(command, type_.unpack(payload))
+    
     message_ping = pack.ComposedType([])
     def handle_ping(self):
         pass
@@ -257,12 +387,84 @@ class Protocol(p2protocol.Protocol):
         ('shares', pack.ListType(p2pool_data.share_type)),
     ])
     def handle_shares(self, shares):
-        self.node.handle_shares([p2pool_data.load_share(share, self.node.net, self) for share in shares if share['type'] not in [6, 7]], self)
+        shares = [p2pool_data.load_share(share, self.node.net, self) for share in shares if share['type'] not in [6, 7]]
+        if self.other_version >= 10:
+            self._queue_compact_shares(shares)
+        else:
+            self.node.handle_shares(shares, self)
+    
+    def _queue_compact_shares(self, shares):
+        # fetching transactions makes handling asynchronous, so chain each message after the last to keep shares in the order they arrived
+        self.incoming_shares.addCallback(lambda _: self._handle_compact_shares(shares))
+        self.incoming_shares.addErrback(log.err, 'Error while handling shares:')
+    
+    @defer.inlineCallbacks
+    def _handle_compact_shares(self, shares):
+        # the peer didn't push the shares' transactions along with them; fetch the ones we don't have before the shares reach the tracker
+        if not self.connected2:
+            return
+        share_tx_hashes = self.node.get_share_tx_hashes_by_share(shares)
+        missing = set(tx_hash for tx_hashes in share_tx_hashes.itervalues() for tx_hash in tx_hashes if tx_hash not in self.node.known_txs_var.value)
+        if missing:
+            try:
+                txs = yield self._get_txs_fragmented(list(missing))
+            except:
+                log.err(None, 'Error while fetching transactions for shares:')
+                return
+            new_txs = dict((tx_hash, tx) for tx_hash, tx in ((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in txs) if tx_hash in missing)
+            self.node.known_txs_var.add(new_txs)
+            missing.difference_update(new_txs)
+            if missing:
+                # the peer didn't return them all; shares can't go into the tracker without their transactions, so drop those that need them
+                dropped = [share for share in shares if share_tx_hashes[share.hash] & missing]
+                print 'Dropping %i shares from %s:%i that reference %i transactions it did not return' % (len(dropped), self.addr[0], self.addr[1], len(missing))
+                shares = [share for share in shares if not share_tx_hashes[share.hash] & missing]
+        if self.connected2 and shares:
+            self.node.handle_shares(shares, self)
+    
+    @defer.inlineCallbacks
+    def _get_txs_fragmented(self, tx_hashes):
+        result, txs = yield self.get_txs(tx_hashes=tx_hashes)
+        if result == 'too long' and len(tx_hashes) > 1:
+            txs = (yield self._get_txs_fragmented(tx_hashes[:len(tx_hashes)//2])) + (yield self._get_txs_fragmented(tx_hashes[len(tx_hashes)//2:]))
+        defer.returnValue(txs)
+    
+    def queueShares(self, shares, tracker, known_txs, include_txs_with=[], priority=1):
+        '''
+        Like sendShares, but waits for shares queued earlier (or with a lower
+        priority number) to be accepted by the peer first, so callers don't
+        block on slow peers. Returns a Deferred that fires once sent.
+        '''
+        df = defer.Deferred()
+        heapq.heappush(self.share_queue, (priority, self.share_queue_seq.next(), time.time(), (shares, tracker, known_txs, include_txs_with), df))
+        if not self.share_queue_running:
+            self._send_share_queue()
+        return df
+    
+    @defer.inlineCallbacks
+    def _send_share_queue(self):
+        self.share_queue_running = True
+        try:
+            while self.share_queue:
+                priority, seq, queued, args, df = heapq.heappop(self.share_queue)
+                try:
+                    yield self.sendShares(*args)
+                except:
+                    df.errback(failure.Failure())
+                else:
+                    self.share_latencies.append(time.time() - queued)
+                    df.callback(None)
+        finally:
+            self.share_queue_running = False
     
     def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
         if not shares:
             return defer.succeed(None)
         
+        if self.other_version >= 10:
+            # compact relay: the peer asks with gettxs for whatever it's missing
+            return self._send_packed_shares(shares)
+        
         if self.other_version >= 8:
             tx_hashes = set()
             for share in shares:
@@ -278,9 +480,9 @@ class Protocol(p2protocol.Protocol):
                 raise ValueError('shares have too many txs')
             self.remote_remembered_txs_size = new_remote_remembered_txs_size
             
-            fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
+            fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if self.remote_has_tx(x)], txs=[known_txs[x] for x in hashes_to_send if not self.remote_has_tx(x)])
         
-        res = fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        res = self._send_packed_shares(shares)
         
         if self.other_version >= 8:
             res = self.send_forget_tx(tx_hashes=hashes_to_send)
@@ -289,6 +491,12 @@ class Protocol(p2protocol.Protocol):
         
         return res
     
+    def _send_packed_shares(self, shares):
+        res = None
+        for run in fragment_packed([p2pool_data.get_packed_share(share) for share in shares], self._max_payload_length):
+            res = self.sendPayload('shares', varint_type.pack(len(run)) + ''.join(run))
+        return res
+    
     
     message_sharereq = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -298,10 +506,12 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_sharereq(self, id, hashes, parents, stops):
         shares = self.node.handle_get_shares(hashes, parents, stops, self)
-        try:
-            self.send_sharereply(id=id, result='good', shares=[share.as_share() for share in shares])
-        except p2protocol.TooLong:
+        packed_shares = [p2pool_data.get_packed_share(share) for share in shares]
+        prefix = tx_hash_type.pack(id) + varint_type.pack(0) # id, result='good'
+        if len(prefix) + varint_type.packed_size(len(packed_shares)) + sum(len(x) for x in packed_shares) > self._max_payload_length:
             self.send_sharereply(id=id, result='too long', shares=[])
+        else:
+            self.sendPayload('sharereply', prefix + varint_type.pack(len(packed_shares)) + ''.join(packed_shares))
     
     message_sharereply = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -316,6 +526,60 @@ class Protocol(p2protocol.Protocol):
         self.get_shares.got_response(id, res)
     
     
+    message_chainreq = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hash', pack.IntType(256)),
+        ('count', pack.VarIntType()),
+    ])
+    def handle_chainreq(self, id, hash, count):
+        self.send_chainreply(id=id, hashes=self.node.handle_get_share_hashes(hash, min(count, 30000), self))
+    
+    message_chainreply = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_chainreply(self, id, hashes):
+        self.get_share_hashes.got_response(id, hashes)
+    
+    def record_download(self, count, dt):
+        rate = count/max(dt, 1e-3)
+        self.download_rate = rate if self.download_rate is None else .8*self.download_rate + .2*rate
+        if dt < 2:
+            self.download_batch_size = min(1000, 2*self.download_batch_size)
+        elif dt > 5:
+            self.download_batch_size = max(10, self.download_batch_size//2)
+    def record_download_failure(self):
+        self.download_batch_size = max(10, self.download_batch_size//2)
+    
+    
+    message_gettxs = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('tx_hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_gettxs(self, id, tx_hashes):
+        txs = []
+        for tx_hash in tx_hashes:
+            if tx_hash in self.node.known_txs_var.value:
+                txs.append(self.node.known_txs_var.value[tx_hash])
+            else:
+                for cache in self.known_txs_cache.itervalues():
+                    if tx_hash in cache:
+                        txs.append(cache[tx_hash])
+                        break
+        try:
+            self.send_txs(id=id, result='good', txs=txs)
+        except p2protocol.TooLong:
+            self.send_txs(id=id, result='too long', txs=[])
+    
+    message_txs = pack.ComposedType([
+        ('id', pack.IntType(256)),
+        ('result', pack.EnumType(pack.VarIntType(), {0: 'good', 1: 'too long'})),
+        ('txs', pack.ListType(bitcoin_data.tx_type)),
+    ])
+    def handle_txs(self, id, result, txs):
+        self.get_txs.got_response(id, (result, txs))
+    
+    
     message_bestblock = pack.ComposedType([
         ('header', bitcoin_data.block_header_type),
     ])
@@ -328,15 +592,80 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_have_tx(self, tx_hashes):
         #assert self.remote_tx_hashes.isdisjoint(tx_hashes)
-        self.remote_tx_hashes.update(tx_hashes)
-        while len(self.remote_tx_hashes) > 10000:
-            self.remote_tx_hashes.pop()
+        self._add_remote_txs(self.remote_tx_hashes, tx_hashes)
     message_losing_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
     ])
     def handle_losing_tx(self, tx_hashes):
         #assert self.remote_tx_hashes.issuperset(tx_hashes)
-        self.remote_tx_hashes.difference_update(tx_hashes)
+        for tx_hash in tx_hashes:
+            self.remote_tx_hashes.pop(tx_hash, None)
+    
+    message_have_txids = pack.ComposedType([
+        ('short_ids', pack.ListType(short_tx_id_type)),
+    ])
+    def handle_have_txids(self, short_ids):
+        self._add_remote_txs(self.remote_tx_short_ids, short_ids)
+    message_lose_txids = pack.ComposedType([
+        ('short_ids', pack.ListType(short_tx_id_type)),
+    ])
+    def handle_lose_txids(self, short_ids):
+        for short_id in short_ids:
+            self.remote_tx_short_ids.pop(short_id, None)
+    
+    def _add_remote_txs(self, view, keys):
+        for key in keys:
+            view[key] = None
+        while len(view) > self.max_remote_txs: # forget the oldest announcements first
+            view.popitem(last=False)
+    
+    def remote_has_tx(self, tx_hash):
+        return tx_hash in self.remote_tx_hashes or (self.remote_tx_short_ids and get_short_tx_id(self.remote_tx_salt, tx_hash) in self.remote_tx_short_ids)
+    
+    def _schedule_tx_announcements(self):
+        if self.announce_delayed is None:
+            self.announce_delayed = reactor.callLater(self.tx_announce_delay, self._send_tx_announcements)
+    
+    def _send_tx_announcements(self):
+        if self.announce_delayed is not None:
+            if self.announce_delayed.active():
+                self.announce_delayed.cancel()
+            self.announce_delayed = None
+        have, self.pending_have_tx = self.pending_have_tx, set()
+        losing, self.pending_losing_tx = self.pending_losing_tx, set()
+        
+        if self.other_version < 9:
+            if losing:
+                fragment(self.send_losing_tx, tx_hashes=list(losing))
+            if have:
+                fragment(self.send_have_tx, tx_hashes=list(have))
+            return
+        
+        losing_short_ids, losing_hashes = [], []
+        for tx_hash in losing:
+            short_id = get_short_tx_id(self.my_tx_salt, tx_hash)
+            if self.announced_short_ids.get(short_id) == tx_hash:
+                del self.announced_short_ids[short_id]
+                losing_short_ids.append(short_id)
+            else:
+                losing_hashes.append(tx_hash)
+        have_short_ids, have_hashes = [], []
+        for tx_hash in have:
+            short_id = get_short_tx_id(self.my_tx_salt, tx_hash)
+            if short_id in self.announced_short_ids: # collides with another announced tx, so send the full hash
+                have_hashes.append(tx_hash)
+            else:
+                self.announced_short_ids[short_id] = tx_hash
+                have_short_ids.append(short_id)
+        
+        if losing_short_ids:
+            fragment(self.send_lose_txids, short_ids=losing_short_ids)
+        if losing_hashes:
+            fragment(self.send_losing_tx, tx_hashes=losing_hashes)
+        if have_short_ids:
+            fragment(self.send_have_txids, short_ids=have_short_ids)
+        if have_hashes:
+            fragment(self.send_have_tx, tx_hashes=have_hashes)
     
     
     message_remember_tx = pack.ComposedType([
@@ -344,6 +673,7 @@ class Protocol(p2protocol.Protocol):
         ('txs', pack.ListType(bitcoin_data.tx_type)),
     ])
     def handle_remember_tx(self, tx_hashes, txs):
+        new_known_txs = {}
         for tx_hash in tx_hashes:
             if tx_hash in self.remembered_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
@@ -355,7 +685,7 @@ class Protocol(p2protocol.Protocol):
             else:
                 for cache in self.known_txs_cache.itervalues():
                     if tx_hash in cache:
-                        tx = cache[tx_hash]
+                        tx = new_known_txs[tx_hash] = cache[tx_hash]
                         print 'Transaction rescued from peer latency cache!'
                         break
                 else:
@@ -365,7 +695,6 @@ class Protocol(p2protocol.Protocol):
             
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-        new_known_txs = dict(self.node.known_txs_var.value)
         warned = False
         for tx in txs:
             tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
@@ -381,7 +710,9 @@ class Protocol(p2protocol.Protocol):
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
             new_known_txs[tx_hash] = tx
-        self.node.known_txs_var.set(new_known_txs)
+        self.node.known_txs_var.add_refs(self, tx_hashes)
+        self.node.known_txs_var.add_refs(self, new_known_txs)
+        self.node.known_txs_var.add(new_known_txs)
         if self.remembered_txs_size >= self.max_remembered_txs_size:
             raise PeerMisbehavingError('too much transaction data stored')
     message_forget_tx = pack.ComposedType([
@@ -392,12 +723,19 @@ class Protocol(p2protocol.Protocol):
             self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
             assert self.remembered_txs_size >= 0
             del self.remembered_txs[tx_hash]
+        self.node.known_txs_var.remove_refs(self, tx_hashes)
     
     
     def connectionLost(self, reason):
         self.connection_lost_event.happened()
         if self.timeout_delayed is not None:
             self.timeout_delayed.cancel()
+        if self.announce_delayed is not None:
+            self.announce_delayed.cancel()
+            self.announce_delayed = None
+        share_queue, self.share_queue = self.share_queue, []
+        for priority, seq, queued, args, df in share_queue:
+            df.errback(reason)
         if self.connected2:
             self.factory.proto_disconnected(self, reason)
             self._stop_thread()
@@ -407,6 +745,9 @@ class Protocol(p2protocol.Protocol):
         if p2pool.DEBUG:
             print "Peer connection lost:", self.addr, reason
         self.get_shares.respond_all(reason)
+        self.get_share_hashes.respond_all(reason)
+        self.get_txs.respond_all(reason)
+        self.node.known_txs_var.set_refs(self, []) # whatever the peer had us remember, whichever version it speaks
     
     @defer.inlineCallbacks
     def do_ping(self):
@@ -558,14 +899,14 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({})):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=None, mining_txs_var=variable.Variable({})):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
         self.addr_store = dict(addr_store)
         self.connect_addrs = connect_addrs
         self.preferred_storage = preferred_storage
-        self.known_txs_var = known_txs_var
+        self.known_txs_var = known_txs_var if known_txs_var is not None else variable.BoundedVariableDict({})
         self.mining_txs_var = mining_txs_var
         
         self.traffic_happened = variable.Event()
@@ -645,6 +986,13 @@ class Node(object):
     def handle_get_shares(self, hashes, parents, stops, peer):
         print 'handle_get_shares', (hashes, parents, stops, peer)
     
+    def handle_get_share_hashes(self, share_hash, count, peer):
+        print 'handle_get_share_hashes', (share_hash, count, peer)
+        return []
+    
+    def get_share_tx_hashes_by_share(self, shares):
+        return dict((share.hash, set()) for share in shares)
+    
     def handle_bestblock(self, header, peer):
         print 'handle_bestblock', header
     
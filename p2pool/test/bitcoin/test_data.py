@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from p2pool.bitcoin import data, networks
@@ -43,6 +44,18 @@ class Test(unittest.TestCase):
     def test_address_to_pubkey_hash(self):
         assert data.address_to_pubkey_hash('1KUCp7YP5FP8ViRxhfszSUJCTAajK6viGy', networks.nets['bitcoin']) == pack.IntType(160).unpack('ca975b00a8c203b8692f5a18d92dc5c2d2ebc57b'.decode('hex'))
     
+    def test_base58(self):
+        for i in xrange(100):
+            d = '\x00'*random.randrange(3) + ''.join(chr(random.randrange(256)) for j in xrange(random.randrange(30)))
+            assert data.base58_decode(data.base58_encode(d)) == d
+        self.assertRaises(ValueError, data.base58_decode, '1KUCp7YP5FP8ViRxhfszSUJCTAajK6viG0')
+    
+    def test_script2_to_address(self):
+        script2 = data.pubkey_hash_to_script2(pack.IntType(160).unpack('ca975b00a8c203b8692f5a18d92dc5c2d2ebc57b'.decode('hex')))
+        for i in xrange(2):
+            assert data.script2_to_address(script2, networks.nets['bitcoin']) == '1KUCp7YP5FP8ViRxhfszSUJCTAajK6viGy'
+        assert data.script2_to_address('\x6a', networks.nets['bitcoin']) is None
+    
     def test_merkle_hash(self):
         assert data.merkle_hash([
             0xb53802b2333e828d6532059f46ecf6b313a42d79f97925e457fbbfda45367e5c,
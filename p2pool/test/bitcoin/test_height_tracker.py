@@ -0,0 +1,78 @@
+import os
+import random
+import tempfile
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import height_tracker
+from p2pool.test.util import test_forest
+from p2pool.util import forest
+
+class FakeBitcoind(object):
+    def __init__(self):
+        self.requested = []
+    
+    def rpc_help(self):
+        return '\ngetblock '
+    
+    def rpc_getblock(self, block_hash_hex):
+        self.requested.append(int(block_hash_hex, 16))
+        return defer.succeed(dict(height=int(block_hash_hex, 16)))
+
+class Test(unittest.TestCase):
+    def test_header_index(self):
+        for i in xrange(20):
+            items = []
+            for hash in xrange(1, 300):
+                items.append((hash, random.randrange(hash) if random.randrange(20) else 1000 + hash))
+            random.shuffle(items)
+            
+            t = forest.Tracker()
+            index = height_tracker.HeaderIndex()
+            while items:
+                n = random.randrange(1, 50)
+                batch, items = items[:n], items[n:]
+                for hash, previous_hash in batch:
+                    t.add(test_forest.FakeShare(hash=hash, previous_hash=previous_hash))
+                assert index.add(batch + batch[:1]) == len(batch)
+                for hash in random.sample(xrange(1, 400), 50):
+                    assert index.get_height_and_last(hash) == t.get_height_and_last(hash)
+            
+            assert len(index) == 299
+            index2 = height_tracker.HeaderIndex()
+            index2.add(index.items())
+            for hash in xrange(1, 300):
+                assert index2.get_height_and_last(hash) == index.get_height_and_last(hash) == t.get_height_and_last(hash)
+    
+    def test_block_height_cache(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = height_tracker.BlockHeightCache(path, max_size=100)
+            for i in xrange(150):
+                cache[2**255 + i] = i
+            assert len(cache) == 100
+            assert 2**255 + 49 not in cache
+            assert cache[2**255 + 50] == 50
+            cache[2**255 + 150] = 150
+            assert 2**255 + 50 in cache and 2**255 + 51 not in cache
+            cache.save()
+            assert not os.path.exists(path + '.new') # written there, then renamed over path
+            
+            cache2 = height_tracker.BlockHeightCache(path, max_size=100)
+            assert len(cache2) == 100
+            assert all(cache2[2**255 + i] == i for i in [50] + range(52, 151))
+        finally:
+            os.remove(path)
+    
+    @defer.inlineCallbacks
+    def test_prefetch(self):
+        bitcoind = FakeBitcoind()
+        get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(bitcoind, None, lambda: 100, None)
+        assert bitcoind.requested == [100]
+        
+        yield get_height_rel_highest.prefetch([1, 2, 2, 3, 100])
+        assert sorted(bitcoind.requested) == [1, 2, 3, 100]
+        assert get_height_rel_highest(2) == -98
+        assert len(bitcoind.requested) == 4
@@ -0,0 +1,193 @@
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool import networks
+from p2pool.bitcoin import data as bitcoin_data, helper
+from p2pool.util import deferral, jsonrpc, math, variable
+
+def make_tx(i):
+    return dict(
+        version=1,
+        tx_ins=[dict(previous_output=dict(hash=i, index=0), script='', sequence=None)],
+        tx_outs=[dict(value=i, script='')],
+        lock_time=0,
+    )
+
+class MockBitcoind(object):
+    '''
+    Serves getblocktemplate with longpollid support. Long polls are answered
+    when set_template changes the template, or by release.
+    '''
+
+    def __init__(self, previous_block=0x16c169477c25421250ec5d32cf9c6d38538b5de970a2355fd89):
+        self.previous_block = previous_block
+        self.txs = []
+        self.curtime = 1351659940
+        self.template_id = 0
+        self.waiting = []
+        self.requests = 0
+        self.submitted = []
+
+    def set_template(self, previous_block=None, txs=None):
+        if previous_block is not None:
+            self.previous_block = previous_block
+        if txs is not None:
+            self.txs = txs
+        self.template_id += 1
+        self.release()
+
+    def release(self):
+        waiting, self.waiting = self.waiting, []
+        for df in waiting:
+            df.callback(None)
+
+    def listen(self):
+        root = resource.Resource()
+        root.putChild('', jsonrpc.Server(self, max_batch_size=100))
+        return reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+
+    def rpc_help(self, request):
+        return '\ngetblock '
+
+    def rpc_getblock(self, request, block_hash_hex):
+        return dict(height=42)
+
+    @defer.inlineCallbacks
+    def rpc_getblocktemplate(self, request, params):
+        self.requests += 1
+        if params.get('longpollid', None) == str(self.template_id):
+            df = defer.Deferred()
+            self.waiting.append(df)
+            yield df
+        self.curtime += 1
+        defer.returnValue({
+            'version': 2,
+            'previousblockhash': '%064x' % (self.previous_block,),
+            'transactions': [dict(data=bitcoin_data.tx_type.pack(tx).encode('hex')) for tx in self.txs],
+            'coinbaseaux': {'flags': '062f503253482f'},
+            'coinbasevalue': 5044450000,
+            'curtime': self.curtime,
+            'bits': '21008000',
+            'height': 205801,
+            'longpollid': str(self.template_id),
+        })
+    
+    def rpc_submitblock(self, request, block_hex):
+        self.submitted.append(block_hex)
+
+class MockConnection(object):
+    def __init__(self):
+        self.payloads = []
+    
+    def sendPayload(self, command, payload):
+        self.payloads.append((command, payload))
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.bitcoind = MockBitcoind()
+        self.bitcoind.set_template(txs=[make_tx(i) for i in xrange(5)])
+        self.port = self.bitcoind.listen()
+        self.proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (self.port.getHost().port,))
+        self.template, self.freshness = yield helper.getwork(self.proxy, True)
+    
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.bitcoind.release()
+        yield self.proxy.close()
+        yield self.port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_block_template(self):
+        template, freshness = self.template, self.freshness
+        assert freshness['longpollid'] == '1'
+        assert template['transactions'] == [make_tx(i) for i in xrange(5)]
+        
+        template2, freshness2 = yield helper.getwork(self.proxy, True, template)
+        assert freshness2['time'] != freshness['time']
+        assert template2 == template and not template2 != template
+        assert template2.fingerprint == template.fingerprint
+        assert all(tx2 is tx for tx, tx2 in zip(template['transactions'], template2['transactions']))
+        
+        self.bitcoind.set_template(txs=[make_tx(i) for i in xrange(6)])
+        template3, freshness3 = yield helper.getwork(self.proxy, True, template2)
+        assert template3 != template2
+        assert template3['transactions'] == [make_tx(i) for i in xrange(6)]
+        assert all(tx3 is tx for tx, tx3 in zip(template['transactions'], template3['transactions']))
+        
+        self.bitcoind.set_template(previous_block=42)
+        template4, freshness4 = yield helper.getwork(self.proxy, True, template3)
+        assert template4 != template3
+        assert template4['transaction_hashes'] == template3['transaction_hashes']
+        
+        changes = []
+        v = variable.Variable(template)
+        v.changed.watch(changes.append)
+        v.set(template2)
+        assert not changes
+        v.set(template3)
+        assert changes == [template3]
+    
+    @defer.inlineCallbacks
+    def test_longpoll(self):
+        res = []
+        helper.getwork(self.proxy, True, self.template, self.freshness['longpollid']).addCallback(res.append)
+        yield deferral.sleep(.2)
+        assert not res
+        
+        self.bitcoind.set_template(txs=[make_tx(i) for i in xrange(1, 7)])
+        yield deferral.sleep(.2)
+        assert len(res) == 1
+        template, freshness = res[0]
+        assert freshness['longpollid'] == '2'
+        assert freshness['latency'] is None
+        assert template['transactions'] == [make_tx(i) for i in xrange(1, 7)]
+    
+    @defer.inlineCallbacks
+    def test_longpoll_timeout(self):
+        old_timeout, helper.LONGPOLL_TIMEOUT = helper.LONGPOLL_TIMEOUT, .2
+        try:
+            template, freshness = yield helper.getwork(self.proxy, True, self.template, self.freshness['longpollid'])
+        finally:
+            helper.LONGPOLL_TIMEOUT = old_timeout
+        assert template == self.template
+        assert freshness['latency'] is not None
+        assert self.bitcoind.requests == 3
+    
+    @defer.inlineCallbacks
+    def test_block_submitter(self):
+        conn = MockConnection()
+        factory = math.Object(conn=variable.Variable(conn))
+        submitter = helper.BlockSubmitter(factory, self.proxy, variable.Variable(self.template), networks.nets['bitcoin'], max_blocks=2)
+        blocks = [dict(
+            header=dict(
+                version=2,
+                previous_block=self.template['previous_block'],
+                merkle_root=i,
+                timestamp=self.freshness['time'],
+                bits=self.template['bits'],
+                nonce=0,
+            ),
+            txs=self.template['transactions'],
+        ) for i in xrange(3)]
+        
+        assert submitter.submit(blocks[0], False)
+        assert not submitter.submit(blocks[0], True)
+        yield deferral.sleep(.2)
+        assert conn.payloads == [('block', bitcoin_data.block_type.pack(blocks[0]))]
+        assert self.bitcoind.submitted == [bitcoin_data.block_type.pack(blocks[0]).encode('hex')]
+        
+        assert submitter.submit(blocks[1], False)
+        assert submitter.submit(blocks[2], False)
+        assert submitter.submit(blocks[0], False) # forgotten once max_blocks newer ones were submitted
+        yield deferral.sleep(.2)
+        assert len(conn.payloads) == len(self.bitcoind.submitted) == 4
+        
+        stats = submitter.get_stats()
+        assert stats['duplicates'] == 1
+        assert sorted(stats['submissions']) == sorted('%064x' % (bitcoin_data.hash256(bitcoin_data.block_header_type.pack(block['header'])),) for block in [blocks[2], blocks[0]])
+        for submission in stats['submissions'].itervalues():
+            assert submission['rpc_attempts'] == 1 and submission['rpc_success'] is True
+            assert submission['p2p_latency'] is not None and submission['rpc_latency'] is not None
+        assert self.proxy.get_stats()['priority_requests'] == 4
@@ -0,0 +1,111 @@
+import base64
+import itertools
+
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+from twisted.web import client, resource, server, static
+
+from p2pool.bitcoin import data as bitcoin_data, getwork, worker_interface
+from p2pool.util import deferral, jsonrpc
+
+class Bridge(worker_interface.WorkerBridge):
+    def __init__(self):
+        worker_interface.WorkerBridge.__init__(self)
+        self.merkle_roots = itertools.count(1)
+        self.users = []
+        self.submissions = []
+    
+    def get_work(self, request):
+        self.users.append(request.getUser())
+        ba = getwork.BlockAttempt(version=2, previous_block=1, merkle_root=self.merkle_roots.next(), timestamp=0, bits=bitcoin_data.FloatingInteger(0x1d00ffff), share_target=2**256 - 1)
+        def got_response(header, request):
+            self.submissions.append((header['merkle_root'], request.getUser()))
+            return True
+        return ba, got_response
+
+class RawClient(protocol.Protocol):
+    def __init__(self):
+        self.data = ''
+        self.lost = defer.Deferred()
+    
+    def dataReceived(self, data):
+        self.data += data
+    
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_fast_path(self):
+        bridge = Bridge()
+        web_root = resource.Resource()
+        web_root.putChild('static', static.Data('hi', 'text/plain'))
+        wi = worker_interface.WorkerInterface(bridge)
+        wi.attach_to(web_root)
+        factory = worker_interface.WorkerServerFactory(wi, server.Site(web_root))
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        url = 'http://127.0.0.1:%i/' % (port.getHost().port,)
+        proxy = jsonrpc.Proxy(url, dict(Authorization='Basic ' + base64.b64encode('user1:pass')))
+        long_poll_proxy = jsonrpc.Proxy(url + 'long-polling', dict(Authorization='Basic ' + base64.b64encode('user2:pass')), timeout=10)
+        try:
+            work1 = yield proxy.rpc_getwork()
+            work2 = yield proxy.rpc_getwork()
+            assert work1['data'] != work2['data']
+            assert (yield proxy.rpc_getwork(work1['data']))
+            assert bridge.users == ['user1', 'user1']
+            assert bridge.submissions == [(1, 'user1')]
+            assert factory.requests == 3
+            assert proxy.get_stats()['connections_made'] == 1
+            
+            long_poll_df = long_poll_proxy.rpc_getwork()
+            yield deferral.sleep(.2)
+            assert not long_poll_df.called
+            bridge.new_work_event.happened()
+            work3 = yield long_poll_df
+            assert work3['data'] != work2['data']
+            assert bridge.users == ['user1', 'user1', 'user2']
+            
+            assert (yield client.getPage(url + 'static')) == 'hi'
+            assert factory.handed_over == 1
+            assert factory.requests == 4
+        finally:
+            yield proxy.close()
+            yield long_poll_proxy.close()
+            yield port.stopListening()
+            wi.merkle_root_to_handler.stop()
+    
+    @defer.inlineCallbacks
+    def test_fast_path_timeout_and_expect(self):
+        bridge = Bridge()
+        web_root = resource.Resource()
+        wi = worker_interface.WorkerInterface(bridge)
+        wi.attach_to(web_root)
+        factory = worker_interface.WorkerServerFactory(wi, server.Site(web_root, timeout=.3))
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        creator = protocol.ClientCreator(reactor, RawClient)
+        body = '{"id": 0, "method": "getwork", "params": []}'
+        try:
+            # a long poll outlasting the timeout is answered, then the idle connection is closed
+            client1 = yield creator.connectTCP('127.0.0.1', port.getHost().port)
+            client1.transport.write('GET /long-polling HTTP/1.1\r\nHost: x\r\n\r\n')
+            yield deferral.sleep(.5)
+            assert not client1.data and not client1.lost.called
+            bridge.new_work_event.happened()
+            yield deferral.sleep(.1)
+            assert client1.data.startswith('HTTP/1.1 200 OK\r\n') and not client1.lost.called
+            yield deferral.sleep(.5)
+            assert client1.lost.called
+            
+            client2 = yield creator.connectTCP('127.0.0.1', port.getHost().port)
+            client2.transport.write('POST / HTTP/1.1\r\nHost: x\r\nExpect: 100-continue\r\nContent-Length: %i\r\n\r\n' % (len(body),))
+            yield deferral.sleep(.1)
+            assert client2.data == 'HTTP/1.1 100 Continue\r\n\r\n'
+            client2.transport.write(body)
+            yield deferral.sleep(.1)
+            assert 'HTTP/1.1 200 OK\r\n' in client2.data and '"result"' in client2.data
+            assert factory.handed_over == 1
+            client2.transport.loseConnection()
+            yield client2.lost
+        finally:
+            yield port.stopListening()
+            wi.merkle_root_to_handler.stop()
@@ -1,3 +1,5 @@
+from __future__ import division
+
 import random
 import unittest
 
@@ -39,3 +41,49 @@ class Test(unittest.TestCase):
         for i in xrange(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+    
+    def test_chain_stats(self):
+        t = data.OkayTracker(None)
+        for i in xrange(200):
+            t.add(test_forest.FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None, timestamp=i*10,
+                share_data=dict(stale_info=random.choice([None, None, None, 'orphan', 'doa']), pubkey_hash=random.randrange(5)),
+                desired_version=random.choice([12, 13]), target=random.choice([2**240, 2**245, 2**250]), max_target=2**250))
+        for i in xrange(200):
+            a = random.randrange(1, 200)
+            n = random.randrange(2, a + 2)
+            chain = list(t.get_chain(a, n - 1))
+            
+            stales = sum(1 for share in t.get_chain(a, n) if share.share_data['stale_info'] is not None)
+            assert data.get_average_stale_prop(t, a, n) == stales/(n + stales)
+            
+            counts = {}
+            versions = {}
+            for share in chain:
+                att = bitcoin_data.target_to_average_attempts(share.target)
+                counts['good'] = counts.get('good', 0) + att
+                if share.share_data['stale_info'] is not None:
+                    counts[share.share_data['stale_info']] = counts.get(share.share_data['stale_info'], 0) + att
+                versions[share.desired_version] = versions.get(share.desired_version, 0) + att
+            assert data.get_stale_counts(t, a, n) == counts
+            assert data.get_desired_version_counts(t, a, n - 1) == versions
+    
+    def test_share_tx_hashes(self):
+        def make_share(i):
+            refs = [dict(share_count=n, tx_count=random.randrange(3)) for n in random.sample(xrange(min(i, 8) + 1), random.randrange(1, min(i, 8) + 2))]
+            return test_forest.FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None,
+                share_info=dict(transaction_hash_refs=refs), new_transaction_hashes=[(i, j) for j in xrange(3)])
+        shares = [make_share(i) for i in xrange(30)]
+        for i in xrange(100):
+            t = forest.Tracker()
+            a = random.randrange(30)
+            b = random.randrange(a, 30)
+            for share in shares[:a]:
+                t.add(share)
+            batch = shares[a:b + 1]
+            random.shuffle(batch)
+            expected = set((share.hash - ref['share_count'], ref['tx_count']) for share in batch for ref in share.share_info['transaction_hash_refs'])
+            assert data.get_share_tx_hashes(t, batch) == expected
+            assert data.get_share_tx_hashes_by_share(t, batch) == dict((share.hash, set((share.hash - ref['share_count'], ref['tx_count']) for ref in share.share_info['transaction_hash_refs'])) for share in batch)
+        
+        t = forest.Tracker()
+        assert data.get_share_tx_hashes(t, shares[20:]) == set((share.hash - ref['share_count'], ref['tx_count']) for share in shares[20:] for ref in share.share_info['transaction_hash_refs'] if ref['share_count'] <= share.hash - 20)
@@ -0,0 +1,103 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+import p2pool
+from p2pool import networks
+from p2pool.bitcoin import data as bitcoin_data, p2p as bitcoin_p2p
+from p2pool.test import test_node
+from p2pool.util import jsonrpc
+
+class BitcoindProvider(object):
+    # test_node's bitcoind, plus what main checks before starting the node
+    def rpc_help(self, request):
+        return test_node.bitcoind.rpc_help() + 'litecoinaddress\n'
+
+    def rpc_getinfo(self, request):
+        return dict(version=80500, testnet=True)
+
+    def rpc_getmininginfo(self, request):
+        return dict(errors='')
+
+    def rpc_getmemorypool(self, request, result=None):
+        return test_node.bitcoind.rpc_getmemorypool(result)
+
+    def rpc_getblock(self, request, block_hash_hex):
+        return test_node.bitcoind.rpc_getblock(block_hash_hex)
+
+class BitcoindP2PProtocol(bitcoin_p2p.Protocol):
+    def handle_getheaders(self, version, have, last):
+        test_node.bitcoinp2p.get_block_header(last).addCallback(lambda header: self.send_headers(headers=[dict(header=header, txs=[])]))
+
+class BitcoindP2PFactory(protocol.ServerFactory):
+    def buildProtocol(self, addr):
+        p = BitcoindP2PProtocol(self.net)
+        p.factory = self
+        return p
+
+    def __init__(self, net):
+        self.net = net
+        self.protocols = set()
+
+    def gotConnection(self, conn):
+        if conn is not None:
+            self.protocols.add(conn)
+
+class P2PoolProcess(protocol.ProcessProtocol):
+    def __init__(self):
+        self.output = []
+        self.started = defer.Deferred()
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        self.output.append(data)
+        if not self.started.called and 'Started successfully!' in ''.join(self.output):
+            self.started.callback(None)
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        if not self.started.called:
+            self.started.errback(AssertionError('p2pool exited before starting:\n' + ''.join(self.output)))
+
+class Test(unittest.TestCase):
+    timeout = 120
+
+    @defer.inlineCallbacks
+    def test_startup(self):
+        net = networks.nets['litecoin_testnet']
+        datadir = tempfile.mkdtemp()
+
+        rpc_root = resource.Resource()
+        rpc_root.putChild('', jsonrpc.Server(BitcoindProvider(), max_batch_size=100))
+        rpc_port = reactor.listenTCP(0, server.Site(rpc_root), interface='127.0.0.1')
+        p2p_factory = BitcoindP2PFactory(net.PARENT)
+        p2p_port = reactor.listenTCP(0, p2p_factory, interface='127.0.0.1')
+
+        pp = P2PoolProcess()
+        reactor.spawnProcess(pp, sys.executable, [sys.executable,
+            os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(p2pool.__file__))), 'run_p2pool.py'),
+            '--net', 'litecoin', '--testnet', '--datadir', datadir, '--disable-upnp', '--no-bugreport',
+            '--address', bitcoin_data.pubkey_hash_to_address(random.randrange(2**160), net.PARENT),
+            '--bitcoind-rpc-port', str(rpc_port.getHost().port), '--bitcoind-p2p-port', str(p2p_port.getHost().port),
+            '--p2pool-port', '0', '--worker-port', '127.0.0.1:0', '--max-conns', '0', '--outgoing-conns', '0',
+            'user', 'pass',
+        ], env=os.environ)
+        try:
+            yield pp.started
+            assert os.path.exists(os.path.join(datadir, 'litecoin_testnet', 'ready_flag'))
+        finally:
+            if not pp.ended.called:
+                pp.transport.signalProcess('KILL')
+            yield pp.ended
+            for p in p2p_factory.protocols:
+                p.transport.loseConnection()
+            yield p2p_port.stopListening()
+            yield rpc_port.stopListening()
+            shutil.rmtree(datadir)
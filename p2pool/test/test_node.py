@@ -3,18 +3,23 @@ from __future__ import division
 import random
 
 from twisted.internet import defer, reactor
+from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web import resource, server
 
-from p2pool import data, node, work
+from p2pool import data, node, p2p, work
 from p2pool.bitcoin import data as bitcoin_data, networks, worker_interface
-from p2pool.util import deferral, jsonrpc, math, variable
+from p2pool.test.bitcoin import test_helper
+from p2pool.util import deferral, forest, jsonrpc, math, variable
 
 @apply
 class bitcoinp2p(object):
     def send_block(self, block):
         pass
     
+    def sendPayload(self, command, payload):
+        pass
+    
     def send_tx(self, tx):
         pass
     
@@ -41,6 +46,10 @@ class factory(object):
         return bitcoinp2p
 
 class bitcoind(object):
+    @classmethod
+    def callRemote(self, method, *params, **kwargs):
+        return getattr(self, 'rpc_' + method)(*params) # options like priority only affect how jsonrpc.Proxy sends the call
+    
     @classmethod
     def rpc_help(self):
         return '\ngetblock '
@@ -148,8 +157,9 @@ class MiniNode(object):
         
         wb = work.WorkerBridge(node=self.n, my_pubkey_hash=random.randrange(2**160), donation_percentage=random.uniform(0, 10), merged_urls=merged_urls, worker_fee=3)
         web_root = resource.Resource()
-        worker_interface.WorkerInterface(wb).attach_to(web_root)
-        self.web_port = reactor.listenTCP(0, server.Site(web_root))
+        wi = worker_interface.WorkerInterface(wb)
+        wi.attach_to(web_root)
+        self.web_port = reactor.listenTCP(0, worker_interface.WorkerServerFactory(wi, server.Site(web_root)))
         
         defer.returnValue(self)
     
@@ -160,7 +170,41 @@ class MiniNode(object):
         yield self.n.stop()
         del self.web_port, self.n
 
+class SyncPeer(object):
+    # serves a chain of shares whose hashes are 0..length-1, each share's parent being the one below it
+    def __init__(self, port, length, fail=False):
+        self.addr = '127.0.0.1', port
+        self.length = length
+        self.fail = fail
+        self.connected2 = True
+        self.download_batch_size = 50
+        self.download_rate = None
+    
+    record_download = p2p.Protocol.__dict__['record_download']
+    record_download_failure = p2p.Protocol.__dict__['record_download_failure']
+    
+    def get_share_hashes(self, hash, count):
+        return defer.succeed(range(hash, max(hash - count, -1), -1))
+    
+    def get_shares(self, hashes, parents, stops):
+        if self.fail:
+            return deferral.sleep(.1).addCallback(lambda _: failure.Failure(defer.TimeoutError()))
+        return defer.succeed([math.Object(hash=share_hash) for share_hash in xrange(hashes[0], max(hashes[0] - parents - 1, -1), -1)])
+
 class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_download_chain(self):
+        n = math.Object(net=mynet, tracker=forest.Tracker(), best_share_var=variable.Variable(None), known_txs_var=variable.BoundedVariableDict({}), mining_txs_var=variable.Variable({}))
+        p2p_node = node.P2PNode(n, port=0)
+        got = []
+        p2p_node.handle_shares = lambda shares, peer: got.extend(share.hash for share in shares)
+        
+        # the good peer runs out of ranges while the failing one still holds one, which has to be handed over rather than dropped
+        good_peer, failing_peer = SyncPeer(1, 100), SyncPeer(2, 100, fail=True)
+        count = yield p2p_node.download_chain(99, good_peer, [failing_peer, good_peer])
+        assert count == 100
+        assert sorted(got) == range(100)
+    
     @defer.inlineCallbacks
     def test_node(self):
         mm_root = resource.Resource()
@@ -182,6 +226,7 @@ class Test(unittest.TestCase):
         for i in xrange(100):
             blah = yield proxy.rpc_getwork()
             yield proxy.rpc_getwork(blah['data'])
+        yield proxy.close()
         
         yield deferral.sleep(3)
         
@@ -202,6 +247,42 @@ class Test(unittest.TestCase):
         yield mm_port.stopListening()
     #test_node.timeout = 15
     
+    @defer.inlineCallbacks
+    def test_longpoll(self):
+        mock_bitcoind = test_helper.MockBitcoind()
+        bitcoind_port = mock_bitcoind.listen()
+        bitcoind_proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (bitcoind_port.getHost().port,))
+        
+        n = node.Node(factory, bitcoind_proxy, [], [], mynet)
+        yield n.start()
+        wb = work.WorkerBridge(node=n, my_pubkey_hash=42, donation_percentage=2, merged_urls=[], worker_fee=3)
+        changes = []
+        n.bitcoind_work.changed.watch(changes.append)
+        work_changes = []
+        wb.current_work.changed.watch(work_changes.append)
+        
+        mock_bitcoind.set_template(txs=[test_helper.make_tx(i) for i in xrange(3)])
+        yield deferral.sleep(.5)
+        assert len(changes) == 1
+        assert n.bitcoind_work.value['transactions'] == [test_helper.make_tx(i) for i in xrange(3)]
+        assert n.mining_txs_var.value == dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in n.bitcoind_work.value['transactions'])
+        
+        last_update = n.bitcoind_work_freshness.value['last_update']
+        factory.new_block.happened(None) # makes work_poller fetch a template that is the same as the current one
+        yield deferral.sleep(.5)
+        assert len(changes) == 1
+        assert n.bitcoind_work_freshness.value['last_update'] > last_update
+        assert n.bitcoind_work_freshness.value['latency'] is not None
+        assert len(work_changes) == 1 # only the first template change
+        
+        wb.stop()
+        n.stop()
+        mock_bitcoind.set_template()
+        yield bitcoind_proxy.close()
+        yield bitcoind_port.stopListening()
+        
+        yield deferral.sleep(20) # waiting for work_poller to exit
+    
     @defer.inlineCallbacks
     def test_nodes(self):
         N = 3
@@ -217,6 +298,7 @@ class Test(unittest.TestCase):
             proxy = jsonrpc.Proxy('http://127.0.0.1:' + str(random.choice(nodes).web_port.getHost().port))
             blah = yield proxy.rpc_getwork()
             yield proxy.rpc_getwork(blah['data'])
+            yield proxy.close()
             yield deferral.sleep(random.expovariate(1/.1))
             print i
             print type(nodes[0].n.tracker.items[nodes[0].n.best_share_var.value])
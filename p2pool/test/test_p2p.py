@@ -1,11 +1,12 @@
 import random
 
-from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.internet import defer, endpoints, error, protocol, reactor
+from twisted.python import failure
 from twisted.trial import unittest
 
 from p2pool import networks, p2p
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral
+from p2pool.util import deferral, math, pack, variable
 
 
 class Test(unittest.TestCase):
@@ -77,3 +78,209 @@ class Test(unittest.TestCase):
             yield n.stop()
         finally:
             p2p.Protocol.max_remembered_txs_size //= 10
+    
+    @defer.inlineCallbacks
+    def test_tx_announcements(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x')], lock_time=0) for i in xrange(100)]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        
+        n1 = p2p.Node(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0, known_txs_var=variable.BoundedVariableDict(dict(zip(tx_hashes[:50], txs[:50]))))
+        n2 = p2p.Node(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            yield deferral.sleep(.1)
+            assert all(peer.remote_has_tx(tx_hash) for tx_hash in tx_hashes[:50])
+            
+            n1.known_txs_var.add(dict(zip(tx_hashes[50:], txs[50:])))
+            n1.known_txs_var.remove(tx_hashes[:25])
+            yield deferral.sleep(p2p.Protocol.tx_announce_delay + .2)
+            assert [peer.remote_has_tx(tx_hash) for tx_hash in tx_hashes] == [False]*25 + [True]*75
+            assert not peer.remote_tx_hashes and len(peer.remote_tx_short_ids) == 75
+        finally:
+            yield n1.stop()
+            yield n2.stop()
+        yield deferral.sleep(20) # waiting for known_txs_cache to expire
+    
+    @defer.inlineCallbacks
+    def test_get_txs(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x'*400000)], lock_time=0) for i in xrange(4)]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        
+        n1 = p2p.Node(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0, known_txs_var=variable.BoundedVariableDict(dict(zip(tx_hashes, txs))))
+        n2 = p2p.Node(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            
+            result, res = yield peer.get_txs(tx_hashes=tx_hashes[:1] + [0])
+            assert (result, res) == ('good', txs[:1])
+            result, res = yield peer.get_txs(tx_hashes=tx_hashes)
+            assert (result, res) == ('too long', [])
+            res = yield peer._get_txs_fragmented(tx_hashes)
+            assert res == txs
+            
+            df = peer.get_txs(tx_hashes=tx_hashes[:1])
+            peer.transport.abortConnection()
+            start = reactor.seconds()
+            try:
+                yield df
+            except error.ConnectionLost:
+                assert reactor.seconds() - start < 1 # failed by the disconnect, not the timeout
+            else:
+                assert False
+        finally:
+            yield n1.stop()
+            yield n2.stop()
+    
+    @defer.inlineCallbacks
+    def test_compact_shares(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x'*100)], lock_time=0) for i in xrange(3)]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        
+        class MyNode(p2p.Node):
+            def get_share_tx_hashes_by_share(self, shares):
+                return dict((share.hash, share.tx_hashes) for share in shares)
+            
+            def handle_shares(self, shares, peer):
+                received.append([share.hash for share in shares])
+        received = []
+        
+        n1 = p2p.Node(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0, known_txs_var=variable.BoundedVariableDict(dict(zip(tx_hashes[:2], txs[:2]))))
+        n2 = MyNode(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            
+            # n1 doesn't have the third transaction, so the share needing it has to be dropped; the later message must still come after the rest
+            peer._queue_compact_shares([math.Object(hash=1, tx_hashes=set(tx_hashes[:1])), math.Object(hash=2, tx_hashes=set(tx_hashes[2:])), math.Object(hash=3, tx_hashes=set())])
+            peer._queue_compact_shares([math.Object(hash=4, tx_hashes=set())])
+            yield deferral.sleep(.5)
+            assert received == [[1, 3], [4]]
+            assert tx_hashes[0] in n2.known_txs_var.value
+        finally:
+            yield n1.stop()
+            yield n2.stop()
+    
+    @defer.inlineCallbacks
+    def test_share_queue(self):
+        n1 = p2p.Node(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0)
+        n2 = p2p.Node(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            
+            sent = []
+            def sendShares(shares, tracker, known_txs, include_txs_with=[]):
+                sent.append(shares)
+                return deferral.sleep(.1) # peer is slow to accept them
+            peer.sendShares = sendShares
+            dfs = [peer.queueShares(['a'], None, {}), peer.queueShares(['b'], None, {}), peer.queueShares(['block'], None, {}, priority=0)]
+            yield defer.DeferredList(dfs)
+            assert sent == [['a'], ['block'], ['b']]
+            assert len(peer.share_latencies) == 3
+            
+            df = peer.queueShares(['c'], None, {})
+            peer.transport.loseConnection()
+            df2 = peer.queueShares(['d'], None, {})
+            yield deferral.sleep(.2)
+            assert sent[-1] == ['c']
+            assert isinstance(df2.result, failure.Failure)
+            df2.addErrback(lambda fail: None)
+        finally:
+            yield n1.stop()
+            yield n2.stop()
+    
+    def test_fragment_packed(self):
+        item_type = pack.VarStrType()
+        for i in xrange(100):
+            items = [item_type.pack('x'*random.randrange(random.choice([10, 1000]))) for j in xrange(random.randrange(500))]
+            max_length = random.randrange(1000, 100000)
+            runs = p2p.fragment_packed(items, max_length)
+            assert sum(runs, []) == items
+            for run in runs:
+                assert len(pack.ListType(item_type).pack([item_type.unpack(x) for x in run])) <= max_length
+            for a, b in zip(runs[:-1], runs[1:]):
+                assert len(pack.ListType(item_type).pack([item_type.unpack(x) for x in a + b[:1]])) > max_length
+    
+    @defer.inlineCallbacks
+    def test_get_share_hashes(self):
+        class MyNode(p2p.Node):
+            def handle_get_share_hashes(self, share_hash, count, peer):
+                return range(share_hash, max(share_hash - count, 0), -1)
+        
+        n1 = MyNode(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0)
+        n2 = p2p.Node(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            
+            hashes = yield peer.get_share_hashes(hash=100000, count=50000)
+            assert hashes == range(100000, 70000, -1) # limited to 30000
+            hashes = yield peer.get_share_hashes(hash=10, count=5)
+            assert hashes == [10, 9, 8, 7, 6]
+            
+            batch_size = peer.download_batch_size
+            peer.record_download(batch_size, .5)
+            assert peer.download_batch_size == 2*batch_size and peer.download_rate == 2*batch_size
+            peer.record_download_failure()
+            assert peer.download_batch_size == batch_size
+            
+            df = peer.get_share_hashes(hash=10, count=5)
+            peer.transport.abortConnection()
+            start = reactor.seconds()
+            try:
+                yield df
+            except error.ConnectionLost:
+                assert reactor.seconds() - start < 1 # failed by the disconnect, not the timeout
+            else:
+                assert False
+        finally:
+            yield n1.stop()
+            yield n2.stop()
+    
+    @defer.inlineCallbacks
+    def test_compression(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script=chr(i)*size)], lock_time=0) for i, size in enumerate([100, 20000, 300000])]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        
+        n1 = p2p.Node(lambda: None, 29334, networks.nets['bitcoin'], desired_outgoing_conns=0, known_txs_var=variable.BoundedVariableDict(dict(zip(tx_hashes, txs))))
+        n2 = p2p.Node(lambda: None, 29335, networks.nets['bitcoin'], connect_addrs=set([('127.0.0.1', 29334)]), desired_outgoing_conns=0)
+        traffic = []
+        n1.traffic_happened.watch(lambda name, bytes: traffic.append((name, bytes)))
+        n1.start()
+        n2.start()
+        try:
+            while not n1.peers or not n2.peers:
+                yield deferral.sleep(.1)
+            peer, = n2.peers.values()
+            assert peer.other_services & p2p.SERVICE_COMPRESSION
+            
+            for tx_hash, tx in zip(tx_hashes, txs):
+                del traffic[:]
+                replies = []
+                yield defer.DeferredList([peer.get_txs(tx_hashes=[tx_hash]).addCallback(replies.append), peer.get_txs(tx_hashes=[]).addCallback(replies.append)])
+                assert replies == [('good', [tx]), ('good', [])] # second reply mustn't overtake the first while it's being compressed
+                sent = sum(bytes for name, bytes in traffic if name == 'p2p/out')
+                if tx_hash == tx_hashes[0]:
+                    assert sent > 100
+                else:
+                    assert sent < 1000
+        finally:
+            yield n1.stop()
+            yield n2.stop()
@@ -0,0 +1,66 @@
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from p2pool import work
+from p2pool.util import deferral, jsonrpc
+
+class AuxProvider(object):
+    def __init__(self, chain_id):
+        self.chain_id = chain_id
+        self.hash = 100 + chain_id
+        self.fail = False
+
+    def rpc_getauxblock(self, request):
+        if self.fail:
+            raise jsonrpc.Error_for_code(-1)(u'failing')
+        return dict(chainid=self.chain_id, hash='%064x' % (self.hash,), target='p2pool')
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_merged_work_manager(self):
+        providers = [AuxProvider(1), AuxProvider(2)]
+        ports = []
+        for provider in providers:
+            root = resource.Resource()
+            root.putChild('', jsonrpc.Server(provider))
+            ports.append(reactor.listenTCP(0, server.Site(root), interface='127.0.0.1'))
+
+        mwm = work.MergedWorkManager([('http://127.0.0.1:%i/' % (port.getHost().port,), 'user:pass') for port in ports], poll_interval=.05, error_delay=.3)
+        changes = []
+        mwm.merged_work.changed.watch(changes.append)
+        mwm.start()
+        try:
+            yield deferral.sleep(.5)
+            assert len(changes) == 1
+            assert sorted(mwm.merged_work.value) == [1, 2]
+            assert all(aux_work['hash'] == 100 + chain_id for chain_id, aux_work in mwm.merged_work.value.iteritems())
+            mm_data = mwm.mm_data
+            assert mm_data.startswith('\xfa\xbemm')
+            assert sorted(index for aux_work, index, hashes in mwm.mm_later) == [0, 1]
+
+            providers[1].hash = 2
+            yield deferral.sleep(.5)
+            assert len(changes) == 2
+            assert mwm.merged_work.value[1]['hash'] == 101 and mwm.merged_work.value[2]['hash'] == 2
+            assert mwm.mm_data != mm_data
+
+            providers[0].fail = True
+            self.flushLoggedErrors(jsonrpc.Error)
+            yield deferral.sleep(.2)
+            providers[0].fail = False
+            yield deferral.sleep(.5)
+            assert len(changes) == 2
+            stats = mwm.get_stats()
+            for port, provider in zip(ports, providers):
+                chain_stats = stats['http://127.0.0.1:%i/' % (port.getHost().port,)]
+                assert chain_stats['chain_id'] == provider.chain_id
+                assert chain_stats['latency'] is not None
+            assert stats['http://127.0.0.1:%i/' % (ports[0].getHost().port,)]['errors'] == 1
+            assert sum(chain['proxy'].get_stats()['connections_made'] for chain in mwm.chains) == 2
+        finally:
+            mwm.stop()
+            self.flushLoggedErrors(jsonrpc.Error)
+            yield deferral.sleep(.1)
+            for port in ports:
+                yield port.stopListening()
@@ -15,3 +15,25 @@ class Test(unittest.TestCase):
             yield deferral.sleep(length)
             end = time.time()
             assert length <= end - start <= length + 0.1
+    
+    @defer.inlineCallbacks
+    def test_result_cache(self):
+        state = [0]
+        calls = []
+        cache = deferral.ResultCache(lambda: state[0], min_age=0, max_age=10)
+        
+        @cache
+        def f(x):
+            calls.append(x)
+            return deferral.sleep(0.01).addCallback(lambda _: (x, state[0]))
+        
+        a, b = f(1), f(1) # second call is coalesced into the first
+        assert (yield a) == (yield b) == (1, 0)
+        assert (yield f(1)) == (1, 0)
+        assert (yield f(2)) == (2, 0)
+        assert calls == [1, 2]
+        
+        state[0] = 1
+        assert (yield f(1)) == (1, 1)
+        assert calls == [1, 2, 1]
+        assert cache.get_stats() == dict(hits=1, misses=3, coalesced=1, entries=2)
@@ -3,6 +3,36 @@ import unittest
 
 from p2pool.util import forest, math
 
+class DistanceSkipList(forest.TrackerSkipList):
+    # the randomized skip list get_nth_parent_hash used before AncestorIndex, kept to cross-check it
+    def get_delta(self, element):
+        return element, 1, self.previous(element)
+    
+    def combine_deltas(self, (from_hash1, dist1, to_hash1), (from_hash2, dist2, to_hash2)):
+        if to_hash1 != from_hash2:
+            raise AssertionError()
+        return from_hash1, dist1 + dist2, to_hash2
+    
+    def initial_solution(self, start, (n,)):
+        return 0, start
+    
+    def apply_delta(self, (dist1, to_hash1), (from_hash2, dist2, to_hash2), (n,)):
+        if to_hash1 != from_hash2:
+            raise AssertionError()
+        return dist1 + dist2, to_hash2
+    
+    def judge(self, (dist, hash), (n,)):
+        if dist > n:
+            return 1
+        elif dist == n:
+            return 0
+        else:
+            return -1
+    
+    def finalize(self, (dist, hash), (n,)):
+        assert dist == n
+        return hash
+
 class DumbTracker(object):
     def __init__(self, items=[]):
         self.items = {} # hash -> item
@@ -192,3 +222,29 @@ class Test(unittest.TestCase):
                     else:
                         break
                 test_tracker(t)
+    
+    def test_get_nth_parent_hash_random(self):
+        for ii in xrange(10):
+            items = []
+            for i in xrange(random.randrange(300)):
+                x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(FakeShare(hash=i, previous_hash=x))
+            
+            t = forest.Tracker()
+            for item in math.shuffled(items):
+                t.add(item)
+                if random.randrange(4) == 0:
+                    try:
+                        t.remove(random.choice(list(t.items)))
+                    except NotImplementedError:
+                        pass
+                
+                if not t.items:
+                    continue
+                d = DumbTracker(t.items.itervalues())
+                skip_list = DistanceSkipList(t)
+                for i in xrange(10):
+                    a = random.choice(list(t.items))
+                    n = random.randrange(d.get_height(a) + 1)
+                    res = t.get_nth_parent_hash(a, n)
+                    assert res == d.get_nth_parent_hash(a, n) == skip_list(a, n), (a, n, res)
@@ -1,9 +1,122 @@
+from __future__ import division
+
+import math
+import os
+import random
+import tempfile
 import unittest
 
 from p2pool.util import graph
 
+class DumbDataView(object):
+    def __init__(self, desc, ds_desc):
+        self.desc = desc
+        self.ds_desc = ds_desc
+        self.last_bin_end = 0
+        self.bins = desc.bin_count*[{}]
+    
+    def _add_datum(self, t, value):
+        if not self.ds_desc.multivalues:
+            value = {'null': value}
+        elif self.ds_desc.multivalue_undefined_means_0 and 'null' not in value:
+            value = dict(value, null=0)
+        shift = max(0, int(math.ceil((t - self.last_bin_end)/self.desc.bin_width)))
+        self.bins = ([{}]*shift + self.bins)[:self.desc.bin_count]
+        self.last_bin_end += shift*self.desc.bin_width
+        
+        bin = int(math.ceil((self.last_bin_end - self.desc.bin_width - t)/self.desc.bin_width))
+        if bin < self.desc.bin_count:
+            self.bins[bin] = self.ds_desc.keep_largest_func(graph.combine_bins(self.bins[bin], dict((k, (v, 1)) for k, v in value.iteritems())))
+    
+    def get_data(self, t):
+        dv = graph.DataView(self.desc, self.ds_desc, self.last_bin_end, self.bins)
+        return dv.get_data(t)
+
 class Test(unittest.TestCase):
     def test_keep_largest(self):
         b = dict(a=1, b=3, c=5, d=7, e=9)
         assert graph.keep_largest(3, 'squashed')(b) == {'squashed': 9, 'd': 7, 'e': 9}
         assert graph.keep_largest(3)(b) == {'c': 5, 'd': 7, 'e': 9}
+    
+    def test_history_file(self):
+        dataview_descriptions = {
+            'short': graph.DataViewDescription(10, 100),
+            'long': graph.DataViewDescription(20, 1000),
+        }
+        datastream_descriptions = {
+            'rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False),
+            'users': graph.DataStreamDescription(dataview_descriptions, multivalues=True, multivalues_keep=3),
+        }
+        filename = os.path.join(tempfile.mkdtemp(), 'graph_db.bin')
+        
+        hf = graph.HistoryFile(filename, datastream_descriptions)
+        assert hf.created
+        hd = graph.HistoryDatabase.from_file(datastream_descriptions, hf)
+        t = 1000000
+        for i in xrange(500):
+            t += random.randrange(10)
+            hd.datastreams['rate'].add_datum(t, random.randrange(100))
+            hd.datastreams['users'].add_datum(t, {random.choice('abcdef'): random.randrange(100)})
+        hf.flush()
+        hf.close()
+        
+        hf2 = graph.HistoryFile(filename, datastream_descriptions)
+        assert not hf2.created
+        hd2 = graph.HistoryDatabase.from_file(datastream_descriptions, hf2)
+        for ds_name in datastream_descriptions:
+            for dv_name in dataview_descriptions:
+                dv, dv2 = hd.datastreams[ds_name].dataviews[dv_name], hd2.datastreams[ds_name].dataviews[dv_name]
+                assert dv.last_bin_end == dv2.last_bin_end
+                assert dv.bins == dv2.bins, (dv.bins, dv2.bins)
+        hf2.close()
+    
+    def test_history_file_long_keys(self):
+        dataview_descriptions = {
+            'short': graph.DataViewDescription(10, 100),
+        }
+        datastream_descriptions = {
+            'users': graph.DataStreamDescription(dataview_descriptions, multivalues=True, multivalues_keep=3),
+        }
+        filename = os.path.join(tempfile.mkdtemp(), 'graph_db.bin')
+        long_key = 'worker.' + 'x'*60
+        
+        hf = graph.HistoryFile(filename, datastream_descriptions)
+        hd = graph.HistoryDatabase.from_file(datastream_descriptions, hf)
+        hd.datastreams['users'].add_datum(1000000, {long_key: 3, 'a': 2, 'y'*300: 1})
+        hf.close()
+        
+        hf2 = graph.HistoryFile(filename, datastream_descriptions)
+        hd2 = graph.HistoryDatabase.from_file(datastream_descriptions, hf2)
+        assert [bin for bin in hd2.datastreams['users'].dataviews['short'].bins if bin] == [{long_key: (3, 1), 'a': (2, 1)}]
+        hf2.close()
+    
+    def test_pseudoshare_traffic(self):
+        dataview_descriptions = {
+            'last_hour': graph.DataViewDescription(150, 60*60),
+            'last_day': graph.DataViewDescription(300, 60*60*24),
+        }
+        datastream_descriptions = {
+            'local_hash_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False),
+            'miner_hash_rates': graph.DataStreamDescription(dataview_descriptions, is_gauge=False, multivalues=True, multivalues_keep=5),
+            'pool_rates': graph.DataStreamDescription(dataview_descriptions, multivalues=True, multivalue_undefined_means_0=True, multivalues_squash_key='other', multivalues_keep=3),
+        }
+        hd = graph.HistoryDatabase.from_obj(datastream_descriptions)
+        dumb = dict((ds_name, dict((dv_name, DumbDataView(dv_desc, ds_desc)) for dv_name, dv_desc in dataview_descriptions.iteritems()))
+            for ds_name, ds_desc in datastream_descriptions.iteritems())
+        
+        t = 1000000
+        for i in xrange(20000):
+            t += random.expovariate(1/0.2) if random.randrange(1000) else random.randrange(10000)
+            for ds_name, value in [
+                ('local_hash_rate', random.randrange(2**32)),
+                ('miner_hash_rates', {'miner%i' % random.randrange(8): random.randrange(2**32)}),
+                ('pool_rates', {random.choice('abcdef'): random.random()}),
+            ]:
+                hd.datastreams[ds_name].add_datum(t, value)
+                for dv in dumb[ds_name].itervalues():
+                    dv._add_datum(t, value)
+        
+        for ds_name in datastream_descriptions:
+            for dv_name in dataview_descriptions:
+                for query_t in [t, t + 100, t + 10000]:
+                    assert hd.datastreams[ds_name].dataviews[dv_name].get_data(query_t) == dumb[ds_name][dv_name].get_data(query_t)
@@ -0,0 +1,206 @@
+import json
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import error, resource, server
+
+from p2pool.util import deferral, jsonrpc
+
+try:
+    from twisted.internet import ssl
+except ImportError: # pyOpenSSL isn't installed
+    ssl = None
+
+class Provider(object):
+    def rpc_echo(self, request, x):
+        return x
+    
+    def rpc_fail(self, request):
+        raise jsonrpc.Error_for_code(-5)(u'failed')
+    
+    @defer.inlineCallbacks
+    def rpc_slow(self, request):
+        yield deferral.sleep(1)
+        defer.returnValue(True)
+
+class UnavailableOnceServer(jsonrpc.Server):
+    # like a proxy in front of the server answering the first request with a plain HTTP error
+    unavailable = True
+    
+    def render_POST(self, request):
+        if self.unavailable:
+            self.unavailable = False
+            request.setResponseCode(503)
+            return 'Service Unavailable'
+        return jsonrpc.Server.render_POST(self, request)
+
+class Test(unittest.TestCase):
+    def listen(self, server_class=jsonrpc.Server, max_batch_size=100):
+        root = resource.Resource()
+        root.putChild('', server_class(Provider(), max_batch_size=max_batch_size))
+        return reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+    
+    @defer.inlineCallbacks
+    def test_proxy(self):
+        port = self.listen()
+        proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (port.getHost().port,), timeout=.5, batch_delay=None)
+        try:
+            for i in xrange(10):
+                res = yield proxy.rpc_echo(i)
+                assert res == i
+            res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(3)])
+            assert res == range(3)
+            
+            try:
+                yield proxy.rpc_fail()
+            except jsonrpc.Error, e:
+                assert e.code == -5
+            else:
+                assert False
+            
+            try:
+                yield proxy.rpc_slow()
+            except defer.TimeoutError:
+                pass
+            else:
+                assert False
+            
+            stats = proxy.get_stats()
+            assert stats['requests'] == 15
+            assert stats['connections_made'] <= 4 # one per concurrent request, plus one to replace the timed out one
+            assert stats['connections_reused'] == 15 - stats['connections_made']
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
+            yield deferral.sleep(1) # let the slow call finish
+    
+    @defer.inlineCallbacks
+    def test_proxy_self_signed_ssl(self):
+        # bitcoind's RPC certificate is usually self-signed
+        key = ssl.KeyPair.generate()
+        root = resource.Resource()
+        root.putChild('', jsonrpc.Server(Provider()))
+        port = reactor.listenSSL(0, server.Site(root), key.selfSignedCert(1, commonName='bitcoind').options(), interface='127.0.0.1')
+        proxy = jsonrpc.Proxy('https://127.0.0.1:%i/' % (port.getHost().port,))
+        try:
+            res = yield proxy.rpc_echo(42)
+            assert res == 42
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
+    if ssl is None:
+        test_proxy_self_signed_ssl.skip = 'pyOpenSSL is not installed'
+    
+    @defer.inlineCallbacks
+    def test_batch(self):
+        port = self.listen()
+        proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (port.getHost().port,))
+        try:
+            res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(250)])
+            assert res == range(250)
+            assert proxy.get_stats()['requests'] == 3
+            assert proxy.get_stats()['batched_calls'] == 250
+            
+            res = yield proxy.rpc_echo('single')
+            assert res == 'single'
+            assert proxy.get_stats()['batches'] == 3
+            
+            res = yield proxy.callBatch([('echo', [1]), ('echo', [[2, 3]])])
+            assert res == [1, [2, 3]]
+            
+            fail_df = proxy.rpc_fail()
+            res = yield proxy.rpc_echo(4)
+            assert res == 4
+            try:
+                yield fail_df
+            except jsonrpc.Error, e:
+                assert e.code == -5
+            else:
+                assert False
+            
+            try:
+                yield proxy.callBatch([('echo', [1]), ('fail', []), ('missing', [])])
+            except jsonrpc.Error, e:
+                assert e.code == -5
+            else:
+                assert False
+            assert proxy.get_stats()['batches'] == 6
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_batch_unsupported(self):
+        port = self.listen(max_batch_size=0) # like servers that predate batch support, treats a batch as one invalid request
+        proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (port.getHost().port,))
+        try:
+            res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(5)])
+            assert res == range(5)
+            res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(5)])
+            assert res == range(5)
+            assert proxy.get_stats()['batches'] == 1
+            assert proxy.get_stats()['requests'] == 11
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_server_batch_limit(self):
+        s = jsonrpc.Server(Provider(), max_batch_size=2)
+        resp = json.loads((yield s.handle_data(None, json.dumps([dict(id=i, method='echo', params=[i]) for i in xrange(2)]))))
+        assert [r['result'] for r in resp] == [0, 1]
+        resp = json.loads((yield s.handle_data(None, json.dumps([dict(id=i, method='echo', params=[i]) for i in xrange(3)]))))
+        assert resp['error']['code'] == -32600
+        
+        resp = json.loads((yield jsonrpc.Server(Provider()).handle_data(None, json.dumps([dict(id=0, method='echo', params=[0])]))))
+        assert resp['error']['code'] == -32600
+    
+    @defer.inlineCallbacks
+    def test_batch_http_error(self):
+        port = self.listen(UnavailableOnceServer)
+        proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (port.getHost().port,))
+        try:
+            try:
+                yield proxy.callBatch([('echo', [1]), ('echo', [2])])
+            except error.Error, e:
+                assert e.status == '503'
+            else:
+                assert False
+            
+            res = yield defer.gatherResults([proxy.rpc_echo(i) for i in xrange(5)])
+            assert res == range(5)
+            assert proxy.get_stats()['batches'] == 2
+            assert proxy.get_stats()['requests'] == 2
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
+    
+    @defer.inlineCallbacks
+    def test_priority(self):
+        port = self.listen()
+        proxy = jsonrpc.Proxy('http://127.0.0.1:%i/' % (port.getHost().port,))
+        try:
+            priority_df = proxy.rpc_slow(priority=True)
+            res = []
+            for i in xrange(3):
+                proxy.rpc_echo(i).addCallback(res.append)
+            yield deferral.sleep(.5)
+            assert not res
+            
+            assert (yield priority_df)
+            yield deferral.sleep(.2)
+            assert res == range(3)
+            stats = proxy.get_stats()
+            assert stats['priority_requests'] == 1
+            assert stats['batches'] == 1
+            assert stats['requests'] == 2
+            
+            try:
+                proxy.rpc_echo(1, urgent=True)
+            except TypeError:
+                pass
+            else:
+                assert False
+        finally:
+            yield proxy.close()
+            yield port.stopListening()
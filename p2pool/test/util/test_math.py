@@ -36,3 +36,12 @@ class Test(unittest.TestCase):
             for x in xrange(n + 1):
                 left, right = math.binomial_conf_interval(x, n)
                 assert 0 <= left <= x/n <= right <= 1, (left, right, x, n)
+    
+    def test_sum_dict(self):
+        a = math.SumDict(x=1, y=2)
+        b = math.SumDict(y=2, z=3)
+        assert a + b == dict(x=1, y=4, z=3)
+        assert a - a == {}
+        assert (a + b) - b == a
+        assert 0 + a == a + 0 == a - 0 == a
+        assert 0 - a == dict(x=-1, y=-2)
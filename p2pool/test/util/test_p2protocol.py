@@ -0,0 +1,53 @@
+import random
+import unittest
+
+from twisted.test import proto_helpers
+
+from p2pool.util import p2protocol, pack
+
+def random_bytes(length):
+    return ''.join(chr(random.randrange(2**8)) for i in xrange(length))
+
+class MyProtocol(p2protocol.Protocol):
+    def __init__(self):
+        p2protocol.Protocol.__init__(self, 'abcd', 100000)
+        self.received = []
+    
+    message_data = pack.ComposedType([
+        ('id', pack.IntType(32)),
+        ('data', pack.VarStrType()),
+    ])
+    def handle_data(self, id, data):
+        self.received.append((id, data))
+
+class Test(unittest.TestCase):
+    def test_framing(self):
+        for i in xrange(20):
+            sender = MyProtocol()
+            sender.transport = proto_helpers.StringTransport()
+            
+            sent = []
+            stream = []
+            for id in xrange(random.randrange(50)):
+                if random.randrange(4) == 0:
+                    stream.append(random_bytes(random.randrange(20)).replace('a', 'b')) # garbage between messages
+                data = random_bytes(random.choice([0, 10, 1000, 20000]))
+                sender.send_data(id=id, data=data)
+                if len(data) <= 10 and random.randrange(5) == 0: # corrupt a message's checksum
+                    stream.append(sender.transport.value()[:20] + chr(ord(sender.transport.value()[20]) ^ 1) + sender.transport.value()[21:])
+                else:
+                    stream.append(sender.transport.value())
+                    sent.append((id, data))
+                sender.transport.clear()
+            stream = ''.join(stream)
+            
+            receiver = MyProtocol()
+            receiver.makeConnection(proto_helpers.StringTransport())
+            pos = 0
+            while pos < len(stream):
+                n = random.choice([1, 3, 100, 10000, 100000])
+                receiver.dataReceived(stream[pos:pos + n])
+                pos += n
+            
+            assert receiver.received == sent
+            assert receiver._recv_length < len('abcd')
@@ -0,0 +1,70 @@
+import unittest
+
+from p2pool.util import variable
+
+class Test(unittest.TestCase):
+    def test_variable_dict(self):
+        d = variable.VariableDict({1: 'a'})
+        added, removed = [], []
+        d.added.watch(added.append)
+        d.removed.watch(removed.append)
+        
+        d.add({1: 'a2', 2: 'b', 3: 'c'})
+        assert d.value == {1: 'a', 2: 'b', 3: 'c'}
+        assert added == [{2: 'b', 3: 'c'}]
+        
+        d.remove([1, 4])
+        assert d.value == {2: 'b', 3: 'c'}
+        assert removed == [{1: 'a'}]
+        
+        d.add({2: 'b'})
+        d.remove([4])
+        assert len(added) == len(removed) == 1
+        assert d.version == 2
+    
+    def test_bounded_variable_dict(self):
+        d = variable.BoundedVariableDict({}, 10, len)
+        removed = []
+        d.removed.watch(removed.append)
+        
+        d.set_refs('mining', [1, 2])
+        d.add({1: 'aaaa', 2: 'bbbb', 3: 'cc'})
+        assert d.size == 10 and not removed
+        
+        d.add({4: 'dd'}) # over by 2; 3 is the only unreferenced tx
+        assert removed == [{3: 'cc'}]
+        assert d.value == {1: 'aaaa', 2: 'bbbb', 4: 'dd'}
+        
+        d.add_refs('peer', [2, 4])
+        d.set_refs('mining', [5]) # 1 becomes unreferenced, 2 is still referenced by peer
+        assert d.value == {1: 'aaaa', 2: 'bbbb', 4: 'dd'}
+        
+        d.add({6: 'eeee'}) # 1 was least recently used
+        assert removed[-1] == {1: 'aaaa'}
+        assert d.size == 10
+        
+        d.remove_refs('peer', [2, 4])
+        d.add({7: 'f'})
+        assert removed[-1] == {6: 'eeee'} # 2 and 4 were used when they lost their last reference
+        assert d.get_stats() == dict(count=3, size=7, max_size=10, referenced_count=0, unreferenced_count=3, unreferenced_size=7)
+        assert d.source_refs == {'mining': set([5])}
+        assert d.ref_counts == {5: 1}
+    
+    def test_bounded_variable_dict_remove_unreferenced(self):
+        d = variable.BoundedVariableDict({}, 10, len)
+        d.set_refs_and_add('mining', {1: 'a', 2: 'b'})
+        d.add({3: 'c', 4: 'd'})
+        d.remove_unreferenced()
+        assert d.value == {1: 'a', 2: 'b'}
+        assert d.size == 2
+    
+    def test_bounded_variable_dict_new_template(self):
+        d = variable.BoundedVariableDict({}, 10, len)
+        d.set_refs_and_add('mining', {1: 'aaaa', 2: 'bbbb'})
+        d.add({3: 'cc'})
+        assert d.size == 10
+        
+        d.set_refs_and_add('mining', {4: 'dddd', 5: 'ee'}) # pool is full; unreferenced txs make room, least recently used first
+        assert d.value == {2: 'bbbb', 4: 'dddd', 5: 'ee'}
+        assert d.ref_counts == {4: 1, 5: 1}
+        assert d.size == 10
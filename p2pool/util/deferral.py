@@ -3,6 +3,7 @@ from __future__ import division
 import itertools
 import random
 import sys
+import time
 
 from twisted.internet import defer, reactor
 from twisted.python import failure, log
@@ -197,3 +198,69 @@ class DeferredCacher(object):
         if default is not self._nothing:
             return default
         raise NotNowError(key)
+
+class ResultCache(object):
+    '''
+    caches results of functions (which may return Deferreds) while get_state()
+    is unchanged. A result is served for at least min_age seconds, even if the
+    state changed, and at most max_age seconds. Concurrent calls for an
+    uncached result share one computation.
+    
+    cache = ResultCache(lambda: best_share_var.value)
+    get_stats = cache(get_stats)
+    '''
+    
+    def __init__(self, get_state, min_age=1, max_age=10):
+        self.get_state = get_state
+        self.min_age = min_age
+        self.max_age = max_age
+        
+        self.results = {} # key -> (state, timestamp, value)
+        self.waiting = {} # key -> list of Deferreds
+        
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    def __call__(self, func):
+        return lambda *args: self.get((func, args), lambda: func(*args))
+    
+    def get(self, key, compute):
+        now = time.time()
+        state = self.get_state()
+        
+        if key in self.results:
+            old_state, timestamp, value = self.results[key]
+            age = now - timestamp
+            if 0 <= age < self.max_age and (age < self.min_age or old_state == state):
+                self.hits += 1
+                return defer.succeed(value)
+        
+        if key in self.waiting:
+            self.coalesced += 1
+            df = defer.Deferred()
+            self.waiting[key].append(df)
+            return df
+        
+        self.misses += 1
+        for k in [k for k, (s, t, v) in self.results.iteritems() if not 0 <= now - t < self.max_age]:
+            del self.results[k]
+        self.waiting[key] = []
+        def cb(value):
+            self.results[key] = state, now, value
+            for df in self.waiting.pop(key):
+                df.callback(value)
+            return value
+        def eb(fail):
+            for df in self.waiting.pop(key):
+                df.errback(fail)
+            return fail
+        return defer.maybeDeferred(compute).addCallbacks(cb, eb)
+    
+    def get_stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            entries=len(self.results),
+        )
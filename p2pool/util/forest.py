@@ -18,34 +18,52 @@ class TrackerSkipList(skiplist.SkipList):
         return self.tracker._delta_type.from_element(self.tracker.items[element]).tail
 
 
-class DistanceSkipList(TrackerSkipList):
-    def get_delta(self, element):
-        return element, 1, self.previous(element)
+class AncestorIndex(object):
+    '''
+    Deterministic binary-lifting index answering "nth parent of item" queries.
     
-    def combine_deltas(self, (from_hash1, dist1, to_hash1), (from_hash2, dist2, to_hash2)):
-        if to_hash1 != from_hash2:
-            raise AssertionError()
-        return from_hash1, dist1 + dist2, to_hash2
+    For each item, jumps[k] is the hash of its 2**k-th ancestor. Tables are
+    filled in when items are added (O(log n) if the parent is already known)
+    and extended lazily otherwise. Since an item's ancestry is fixed by its
+    hash, entries never go stale; they only need to be dropped when their item
+    is removed.
+    '''
     
-    def initial_solution(self, start, (n,)):
-        return 0, start
+    def __init__(self, tracker):
+        self.tracker = tracker
+        
+        self._jumps = {} # item_hash -> [1st ancestor, 2nd ancestor, 4th ancestor, ...]
+        
+        self.tracker.added.watch_weakref(self, lambda self, item: self._handle_added(item))
+        self.tracker.removed.watch_weakref(self, lambda self, item: self._jumps.pop(item.hash, None))
     
-    def apply_delta(self, (dist1, to_hash1), (from_hash2, dist2, to_hash2), (n,)):
-        if to_hash1 != from_hash2:
-            raise AssertionError()
-        return dist1 + dist2, to_hash2
+    def _handle_added(self, item):
+        jumps = [self.tracker._delta_type.from_element(item).tail]
+        while True:
+            level = len(jumps) - 1
+            mid_jumps = self._jumps.get(jumps[level])
+            if mid_jumps is None or len(mid_jumps) <= level:
+                break
+            jumps.append(mid_jumps[level])
+        self._jumps[item.hash] = jumps
     
-    def judge(self, (dist, hash), (n,)):
-        if dist > n:
-            return 1
-        elif dist == n:
-            return 0
-        else:
-            return -1
+    def _get_jump(self, item_hash, level):
+        jumps = self._jumps.get(item_hash)
+        if jumps is None:
+            jumps = self._jumps[item_hash] = [self.tracker._delta_type.from_element(self.tracker.items[item_hash]).tail]
+        while len(jumps) <= level:
+            jumps.append(self._get_jump(jumps[-1], len(jumps) - 1))
+        return jumps[level]
     
-    def finalize(self, (dist, hash), (n,)):
-        assert dist == n
-        return hash
+    def __call__(self, item_hash, n):
+        assert n >= 0
+        level = 0
+        while n:
+            if n & 1:
+                item_hash = self._get_jump(item_hash, level)
+            n >>= 1
+            level += 1
+        return item_hash
 
 def get_attributedelta_type(attrs): # attrs: {name: func}
     class ProtoAttributeDelta(object):
@@ -226,7 +244,7 @@ class Tracker(object):
         self.remove_special2 = variable.Event()
         self.removed = variable.Event()
         
-        self.get_nth_parent_hash = DistanceSkipList(self)
+        self.get_nth_parent_hash = AncestorIndex(self)
         
         self._delta_type = delta_type
         self._default_view = TrackerView(self, delta_type)
@@ -333,6 +351,7 @@ class Tracker(object):
         if child_last != last:
             return None # not connected, so can't be determined
         height_up = child_height - height
+        # O(log height_up) jumps; an O(1) test would need tour intervals, which joining chains on add invalidates
         return height_up >= 0 and self.get_nth_parent_hash(possible_child_hash, height_up) == item_hash
 
 class SubsetTracker(Tracker):
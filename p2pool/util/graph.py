@@ -1,7 +1,13 @@
 from __future__ import absolute_import
 from __future__ import division
 
+import hashlib
+import heapq
 import math
+import mmap
+import os
+import struct
+import sys
 
 from p2pool.util import math as math2
 
@@ -11,32 +17,43 @@ class DataViewDescription(object):
         self.bin_count = bin_count
         self.bin_width = total_width/bin_count
 
-def _shift(x, shift, pad_item):
-    left_pad = math2.clip(shift, (0, len(x)))
-    right_pad = math2.clip(-shift, (0, len(x)))
-    return [pad_item]*left_pad + x[right_pad:-left_pad if left_pad else None] + [pad_item]*right_pad
-
 combine_bins = math2.add_dicts_ext(lambda (a1, b1), (a2, b2): (a1+a2, b1+b2), (0, 0))
 
 nothing = object()
 def keep_largest(n, squash_key=nothing, key=lambda x: x, add_func=lambda a, b: a+b):
     def _(d):
-        items = sorted(d.iteritems(), key=lambda (k, v): (k != squash_key, key(v)), reverse=True)
-        while len(items) > n:
-            k, v = items.pop()
-            if squash_key is not nothing:
-                items[-1] = squash_key, add_func(items[-1][1], v)
-        return dict(items)
+        if len(d) <= n:
+            return d
+        if squash_key is nothing:
+            return dict(heapq.nlargest(n, d.iteritems(), key=lambda (k, v): key(v)))
+        res = dict(heapq.nlargest(n - 1, ((k, v) for k, v in d.iteritems() if k != squash_key), key=lambda (k, v): key(v)))
+        res[squash_key] = reduce(add_func, (v for k, v in d.iteritems() if k not in res))
+        return res
     return _
 
 class DataView(object):
+    '''
+    Bins are kept in a circular buffer, newest first starting at _head, so
+    advancing time only clears the bins being reused.
+    '''
+    
     def __init__(self, desc, ds_desc, last_bin_end, bins):
         assert len(bins) == desc.bin_count
         
         self.desc = desc
         self.ds_desc = ds_desc
         self.last_bin_end = last_bin_end
-        self.bins = bins
+        self._bins = [dict(bin) for bin in bins] # copied, since bins are updated in place
+        self._head = 0
+        
+        self.on_change = None # called with (dataview, indices of changed bins)
+    
+    @property
+    def bins(self):
+        return self._bins[self._head:] + self._bins[:self._head]
+    
+    def get_bin(self, i):
+        return self._bins[(self._head + i) % self.desc.bin_count]
     
     def _add_datum(self, t, value):
         if not self.ds_desc.multivalues:
@@ -44,40 +61,56 @@ class DataView(object):
         elif self.ds_desc.multivalue_undefined_means_0 and 'null' not in value:
             value = dict(value, null=0) # use null to hold sample counter
         shift = max(0, int(math.ceil((t - self.last_bin_end)/self.desc.bin_width)))
-        self.bins = _shift(self.bins, shift, {})
-        self.last_bin_end += shift*self.desc.bin_width
+        if shift:
+            self._head = (self._head - shift) % self.desc.bin_count
+            for i in xrange(min(shift, self.desc.bin_count)):
+                self._bins[(self._head + i) % self.desc.bin_count] = {}
+            self.last_bin_end += shift*self.desc.bin_width
         
         bin = int(math.ceil((self.last_bin_end - self.desc.bin_width - t)/self.desc.bin_width))
         if bin < self.desc.bin_count:
-            self.bins[bin] = self.ds_desc.keep_largest_func(combine_bins(self.bins[bin], dict((k, (v, 1)) for k, v in value.iteritems())))
+            pos = (self._head + bin) % self.desc.bin_count
+            d = self._bins[pos]
+            for k, v in value.iteritems():
+                total, count = d.get(k, (0, 0))
+                d[k] = total + v, count + 1
+            if len(d) > self.ds_desc.multivalues_keep:
+                self._bins[pos] = self.ds_desc.keep_largest_func(d)
+        
+        if self.on_change is not None:
+            self.on_change(self, range(min(shift, self.desc.bin_count)) + ([bin] if shift <= bin < self.desc.bin_count else []))
     
     def get_data(self, t):
         shift = max(0, int(math.ceil((t - self.last_bin_end)/self.desc.bin_width)))
-        bins = _shift(self.bins, shift, {})
         last_bin_end = self.last_bin_end + shift*self.desc.bin_width
         
         assert last_bin_end - self.desc.bin_width <= t <= last_bin_end
         
-        def _((i, bin)):
-            left, right = last_bin_end - self.desc.bin_width*(i + 1), min(t, last_bin_end - self.desc.bin_width*i)
+        bin_width = self.desc.bin_width
+        is_gauge, undefined_means_0, multivalues = self.ds_desc.is_gauge, self.ds_desc.multivalue_undefined_means_0, self.ds_desc.multivalues
+        empty = {}
+        res = []
+        for i in xrange(self.desc.bin_count):
+            bin = self.get_bin(i - shift) if i >= shift else empty
+            left, right = last_bin_end - bin_width*(i + 1), min(t, last_bin_end - bin_width*i)
             center, width = (left+right)/2, right-left
-            if self.ds_desc.is_gauge and self.ds_desc.multivalue_undefined_means_0:
+            if is_gauge and undefined_means_0:
                 real_count = max([0] + [count for total, count in bin.itervalues()])
                 if real_count == 0:
                     val = None
                 else:
                     val = dict((k, total/real_count) for k, (total, count) in bin.iteritems())
                 default = 0
-            elif self.ds_desc.is_gauge and not self.ds_desc.multivalue_undefined_means_0:
+            elif is_gauge and not undefined_means_0:
                 val = dict((k, total/count) for k, (total, count) in bin.iteritems())
                 default = None
             else:
                 val = dict((k, total/width) for k, (total, count) in bin.iteritems())
                 default = 0
-            if not self.ds_desc.multivalues:
+            if not multivalues:
                 val = None if val is None else val.get('null', default)
-            return center, val, width, default
-        return map(_, enumerate(bins))
+            res.append((center, val, width, default))
+        return res
 
 
 class DataStreamDescription(object):
@@ -85,6 +118,7 @@ class DataStreamDescription(object):
         self.dataview_descriptions = dataview_descriptions
         self.is_gauge = is_gauge
         self.multivalues = multivalues
+        self.multivalues_keep = multivalues_keep
         self.keep_largest_func = keep_largest(multivalues_keep, multivalues_squash_key, key=lambda (t, c): t/c if self.is_gauge else t, add_func=lambda (a1, b1), (a2, b2): (a1+a2, b1+b2))
         self.multivalue_undefined_means_0 = multivalue_undefined_means_0
         self.default_func = default_func
@@ -134,3 +168,140 @@ class HistoryDatabase(object):
     def to_obj(self):
         return dict((ds_name, dict((dv_name, dict(last_bin_end=dv.last_bin_end, bin_width=dv.desc.bin_width, bins=dv.bins))
             for dv_name, dv in ds.dataviews.iteritems())) for ds_name, ds in self.datastreams.iteritems())
+    
+    @classmethod
+    def from_file(cls, datastream_descriptions, history_file, obj={}):
+        if history_file.created:
+            res = cls.from_obj(datastream_descriptions, obj)
+            for ds_name, ds in res.datastreams.iteritems():
+                for dv_name, dv in ds.dataviews.iteritems():
+                    history_file.write_dataview(ds_name, dv_name, dv, xrange(dv.desc.bin_count))
+        else:
+            res = cls(dict(
+                (ds_name, DataStream(ds_desc, dict(
+                    (dv_name, DataView(dv_desc, ds_desc, *history_file.read_dataview(ds_name, dv_name)))
+                    for dv_name, dv_desc in ds_desc.dataview_descriptions.iteritems()
+                )))
+                for ds_name, ds_desc in datastream_descriptions.iteritems()
+            ))
+        for ds_name, ds in res.datastreams.iteritems():
+            for dv_name, dv in ds.dataviews.iteritems():
+                dv.on_change = lambda dv, bins, ds_name=ds_name, dv_name=dv_name: history_file.mark_dirty(ds_name, dv_name, dv, bins)
+        return res
+
+
+class HistoryFile(object):
+    '''
+    Round-robin binary store for a HistoryDatabase.
+    
+    Every dataview gets a fixed region holding its last_bin_end followed by
+    bin_count fixed-size slots. The bin ending at k*bin_width lives in slot
+    k % bin_count, so advancing time only rewrites the slots being reused.
+    Changed bins are recorded by mark_dirty() and written in place into the
+    memory-mapped file by flush(), which leaves it to the OS to write out only
+    the dirty pages.
+    
+    Multivalue keys are stored whole. A slot has room for multivalues_keep
+    keys averaging 35 bytes; a value whose key doesn't fit in what's left of
+    its slot is dropped and logged rather than stored under a truncated key.
+    '''
+    
+    MAGIC = 'p2pool-graph-db\x00'
+    ENTRY_SIZE = 48 # slot budget per value, enough for a key of 35 bytes
+    MAX_KEY_LEN = 254 # length byte 255 marks the squash key
+    
+    _header = struct.Struct('<d')
+    _entry = struct.Struct('<dI')
+    
+    def __init__(self, filename, datastream_descriptions):
+        self.regions = {} # (ds_name, dv_name) -> (offset, slot_size, bin_count, bin_width)
+        self._dirty = {} # (ds_name, dv_name) -> (dataview, set of changed bin numbers)
+        self._dropped_keys = set() # so each is only logged once
+        layout = []
+        pos = len(self.MAGIC) + 32
+        for ds_name, ds_desc in sorted(datastream_descriptions.iteritems()):
+            slot_size = 1 + (ds_desc.multivalues_keep if ds_desc.multivalues else 1)*self.ENTRY_SIZE
+            for dv_name, dv_desc in sorted(ds_desc.dataview_descriptions.iteritems()):
+                layout.append((ds_name, dv_name, dv_desc.bin_count, dv_desc.bin_width, slot_size))
+                self.regions[ds_name, dv_name] = pos, slot_size, dv_desc.bin_count, dv_desc.bin_width
+                pos += self._header.size + dv_desc.bin_count*slot_size
+        header = self.MAGIC + hashlib.sha256(repr(layout)).digest()
+        
+        self.created = not os.path.exists(filename) or os.path.getsize(filename) != pos
+        if not self.created:
+            with open(filename, 'rb') as f:
+                self.created = f.read(len(header)) != header
+        if self.created:
+            with open(filename, 'wb') as f:
+                f.truncate(pos)
+        
+        self._file = open(filename, 'r+b')
+        self.mmap = mmap.mmap(self._file.fileno(), pos)
+        if self.created:
+            self.mmap[:len(header)] = header
+    
+    def _get_slot_offsets(self, ds_name, dv_name, last_bin_end):
+        offset, slot_size, bin_count, bin_width = self.regions[ds_name, dv_name]
+        k = int(round(last_bin_end/bin_width))
+        return [offset + self._header.size + (k - 1 - i) % bin_count * slot_size for i in xrange(bin_count)], slot_size
+    
+    def _pack_bin(self, bin, slot_size):
+        res = []
+        size = 1
+        for k, (total, count) in sorted(bin.iteritems(), key=lambda (k, (total, count)): (k != 'null', -total)):
+            if k is None: # squash key
+                entry = '\xff' + self._entry.pack(total, count)
+            else:
+                k = k.encode('utf-8') if isinstance(k, unicode) else k
+                entry = chr(len(k)) + k + self._entry.pack(total, count) if len(k) <= self.MAX_KEY_LEN else None
+            if entry is None or size + len(entry) > slot_size:
+                if k not in self._dropped_keys:
+                    self._dropped_keys.add(k)
+                    print >>sys.stderr, 'Graph history: not saving value for key %r, which is too long to fit in its slot' % (k,)
+                continue
+            res.append(entry)
+            size += len(entry)
+        return chr(len(res)) + ''.join(res)
+    
+    def _unpack_bin(self, pos):
+        res = {}
+        n = ord(self.mmap[pos])
+        pos += 1
+        for i in xrange(n):
+            key_len = ord(self.mmap[pos])
+            if key_len == 255:
+                k, key_len = None, 0
+            else:
+                k = self.mmap[pos + 1:pos + 1 + key_len]
+            total, count = self._entry.unpack_from(self.mmap, pos + 1 + key_len)
+            res[k] = total, count
+            pos += 1 + key_len + self._entry.size
+        return res
+    
+    def read_dataview(self, ds_name, dv_name):
+        last_bin_end, = self._header.unpack_from(self.mmap, self.regions[ds_name, dv_name][0])
+        slot_offsets, slot_size = self._get_slot_offsets(ds_name, dv_name, last_bin_end)
+        return last_bin_end, map(self._unpack_bin, slot_offsets)
+    
+    def write_dataview(self, ds_name, dv_name, dv, bins):
+        self._header.pack_into(self.mmap, self.regions[ds_name, dv_name][0], dv.last_bin_end)
+        slot_offsets, slot_size = self._get_slot_offsets(ds_name, dv_name, dv.last_bin_end)
+        for i in bins:
+            data = self._pack_bin(dv.get_bin(i), slot_size)
+            self.mmap[slot_offsets[i]:slot_offsets[i] + len(data)] = data
+    
+    def mark_dirty(self, ds_name, dv_name, dv, bins):
+        k = int(round(dv.last_bin_end/self.regions[ds_name, dv_name][3]))
+        self._dirty.setdefault((ds_name, dv_name), (dv, set()))[1].update(k - 1 - i for i in bins)
+    
+    def flush(self):
+        for (ds_name, dv_name), (dv, bin_numbers) in self._dirty.iteritems():
+            k = int(round(dv.last_bin_end/self.regions[ds_name, dv_name][3]))
+            self.write_dataview(ds_name, dv_name, dv, [k - 1 - n for n in bin_numbers if 0 <= k - 1 - n < dv.desc.bin_count])
+        self._dirty.clear()
+        self.mmap.flush()
+    
+    def close(self):
+        self.flush()
+        self.mmap.close()
+        self._file.close()
@@ -1,11 +1,13 @@
 from __future__ import division
 
+import itertools
 import json
 import weakref
 
-from twisted.internet import defer
-from twisted.python import log
-from twisted.web import client, error
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+from twisted.web import client, error, http_headers, iweb
+from zope.interface import implementer
 
 from p2pool.util import deferred_resource, memoize
 
@@ -34,65 +36,304 @@ def Error_for_code(code):
             Error.__init__(self, code, *args, **kwargs)
     return NarrowError
 
+class _HTTPConnectionPool(client.HTTPConnectionPool):
+    cachedConnectionTimeout = 15 # short enough that idle connections don't pile up on the server
+    
+    def __init__(self, maxPersistentPerHost):
+        client.HTTPConnectionPool.__init__(self, reactor)
+        self.maxPersistentPerHost = maxPersistentPerHost
+        self.connections_made = 0
+    
+    def _newConnection(self, key, endpoint):
+        self.connections_made += 1
+        return client.HTTPConnectionPool._newConnection(self, key, endpoint)
+
+@implementer(iweb.IPolicyForHTTPS)
+class _NonVerifyingPolicyForHTTPS(object):
+    # matches getPage, which Agent replaced - bitcoind's RPC certificate is usually self-signed
+    def creatorForNetloc(self, hostname, port):
+        from twisted.internet import ssl # needs pyOpenSSL, which only https requires
+        return ssl.ClientContextFactory()
+
+class _StringProducer(object):
+    # unlike client.FileBodyProducer, writes the body immediately so that it goes out in the same packet as the headers
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+    
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+    
+    def pauseProducing(self):
+        pass
+    
+    def stopProducing(self):
+        pass
+
 class Proxy(object):
-    def __init__(self, url, headers={}, timeout=5):
+    def __init__(self, url, headers={}, timeout=5, persistent_connections=2, batch_delay=0, max_batch_size=100):
         self._url = url
         self._headers = headers
         self._timeout = timeout
+        self._pool = _HTTPConnectionPool(persistent_connections)
+        self._agent = client.Agent(reactor, _NonVerifyingPolicyForHTTPS(), pool=self._pool)
+        self._batch_delay = batch_delay # calls made within this many seconds of each other are sent as one batch; None disables
+        self._max_batch_size = max_batch_size
+        self._batch_supported = True
+        self._queued_calls = []
+        self._flush_call = None
+        self._priority_calls = 0 # while nonzero, other calls are held in the queue
+        self._id_generator = itertools.count()
+        self.requests = 0
+        self.retries = 0
+        self.batches = 0
+        self.batched_calls = 0
+        self.priority_requests = 0
     
     @defer.inlineCallbacks
-    def callRemote(self, method, *params):
-        id_ = 0
-        
+    def _post(self, data, timeout):
+        pending = [None]
+        timer = reactor.callLater(timeout, lambda: pending[0].cancel())
+        try:
+            for attempt in xrange(2):
+                try:
+                    pending[0] = self._agent.request('POST', self._url,
+                        http_headers.Headers(dict((k, [v]) for k, v in dict(self._headers, **{'Content-Type': 'application/json'}).iteritems())),
+                        _StringProducer(data),
+                    )
+                    response = yield pending[0]
+                except (client.ResponseNeverReceived, client.RequestTransmissionFailed):
+                    if attempt or not timer.active():
+                        raise
+                    self.retries += 1 # the server probably closed a kept-alive connection; try once more on a new one
+                else:
+                    break
+            pending[0] = client.readBody(response)
+            body = yield pending[0]
+        except:
+            if not timer.active():
+                raise defer.TimeoutError('JSON-RPC request timed out')
+            raise
+        finally:
+            if timer.active():
+                timer.cancel()
+        defer.returnValue((response, body))
+    
+    @defer.inlineCallbacks
+    def _request(self, req, timeout=None):
+        self.requests += 1
+        response, data = yield self._post(json.dumps(req), timeout if timeout is not None else self._timeout)
         try:
-            data = yield client.getPage(
-                url=self._url,
-                method='POST',
-                headers=dict(self._headers, **{'Content-Type': 'application/json'}),
-                postdata=json.dumps({
-                    'jsonrpc': '2.0',
-                    'method': method,
-                    'params': params,
-                    'id': id_,
-                }),
-                timeout=self._timeout,
-            )
-        except error.Error, e:
-            try:
-                resp = json.loads(e.response)
-            except:
-                raise e
-        else:
             resp = json.loads(data)
+        except ValueError:
+            if response.code != 200:
+                raise error.Error(response.code, response.phrase, data)
+            raise
+        defer.returnValue(resp)
+    
+    def _get_result(self, resp):
+        if 'error' in resp and resp['error'] is not None:
+            raise Error_for_code(resp['error']['code'])(resp['error']['message'], resp['error'].get('data', None))
+        return resp['result']
+    
+    @defer.inlineCallbacks
+    def _call_single(self, method, params, timeout=None):
+        id_ = self._id_generator.next()
+        
+        resp = yield self._request({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': id_,
+        }, timeout)
         
         if resp['id'] != id_:
             raise ValueError('invalid id')
-        if 'error' in resp and resp['error'] is not None:
-            raise Error_for_code(resp['error']['code'])(resp['error']['message'], resp['error'].get('data', None))
-        defer.returnValue(resp['result'])
+        defer.returnValue(self._get_result(resp))
+    
+    @defer.inlineCallbacks
+    def _call_batch(self, calls):
+        ids = [self._id_generator.next() for call in calls]
+        try:
+            self.batches += 1
+            self.batched_calls += len(calls)
+            resp = yield self._request([{
+                'jsonrpc': '2.0',
+                'method': method,
+                'params': params,
+                'id': id_,
+            } for id_, (method, params, df) in zip(ids, calls)])
+        except:
+            # including HTTP errors without a JSON body, which say nothing about batch support
+            f = failure.Failure()
+            for method, params, df in calls:
+                df.errback(f)
+            return
+        
+        if not isinstance(resp, list):
+            # the server answered with a single error object, so it doesn't understand batch requests; stop using them and send these calls one at a time
+            self._batch_supported = False
+            for method, params, df in calls:
+                self._call_single(method, params).chainDeferred(df)
+            return
+        
+        resps = dict((r['id'], r) for r in resp if isinstance(r, dict) and 'id' in r)
+        for id_, (method, params, df) in zip(ids, calls):
+            if id_ not in resps:
+                df.errback(ValueError('no response for id'))
+                continue
+            try:
+                result = self._get_result(resps[id_])
+            except:
+                df.errback()
+            else:
+                df.callback(result)
+    
+    def _queue_call(self, method, params):
+        df = defer.Deferred()
+        self._queued_calls.append((method, params, df))
+        return df
+    
+    def _flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._priority_calls:
+            return # sent once the priority calls finish
+        
+        calls, self._queued_calls = self._queued_calls, []
+        for i in xrange(0, len(calls), self._max_batch_size):
+            chunk = calls[i:i + self._max_batch_size]
+            if len(chunk) == 1 or not self._batch_supported:
+                for method, params, df in chunk:
+                    self._call_single(method, params).chainDeferred(df)
+            else:
+                self._call_batch(chunk)
+    
+    @defer.inlineCallbacks
+    def _call_priority(self, method, params, timeout):
+        self._priority_calls += 1
+        self.priority_requests += 1
+        try:
+            result = yield self._call_single(method, params, timeout)
+        finally:
+            self._priority_calls -= 1
+            if not self._priority_calls and self._queued_calls:
+                self._flush()
+        defer.returnValue(result)
+    
+    def callRemote(self, method, *params, **kwargs):
+        timeout = kwargs.pop('timeout', None) # overrides the proxy's timeout for this call, which is then never batched
+        priority = kwargs.pop('priority', False) # sent right away, holding back other calls until it finishes
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %r' % (kwargs.keys(),))
+        
+        if priority:
+            return self._call_priority(method, params, timeout)
+        
+        if timeout is not None or (not self._priority_calls and (self._batch_delay is None or not self._batch_supported)):
+            return self._call_single(method, params, timeout)
+        
+        df = self._queue_call(method, params)
+        if self._priority_calls:
+            return df # sent once the priority calls finish
+        if len(self._queued_calls) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self._batch_delay, self._flush)
+        return df
+    
+    @defer.inlineCallbacks
+    def callBatch(self, calls):
+        '''
+        Sends calls, a list of (method, params) pairs, in one batch request
+        along with any queued calls. Returns the list of results, or fails with
+        the first call's error.
+        '''
+        dfs = [self._queue_call(method, params) for method, params in calls]
+        self._flush()
+        results = yield defer.DeferredList(dfs, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        defer.returnValue([result for success, result in results])
+    
+    def get_stats(self):
+        return dict(
+            requests=self.requests,
+            connections_made=self._pool.connections_made,
+            connections_reused=self.requests + self.retries - self._pool.connections_made,
+            retries=self.retries,
+            batches=self.batches,
+            batched_calls=self.batched_calls,
+            priority_requests=self.priority_requests,
+        )
+    
+    def close(self):
+        return self._pool.closeCachedConnections()
     
     def __getattr__(self, attr):
         if attr.startswith('rpc_'):
-            return lambda *params: self.callRemote(attr[len('rpc_'):], *params)
+            method = attr[len('rpc_'):]
+            def call(*params, **kwargs):
+                # timeout and priority are options of the call, never sent as params
+                timeout = kwargs.pop('timeout', None)
+                priority = kwargs.pop('priority', False)
+                if kwargs:
+                    raise TypeError('unexpected keyword arguments %r' % (kwargs.keys(),))
+                return self.callRemote(method, *params, timeout=timeout, priority=priority)
+            return call
         raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, attr))
 
 class Server(deferred_resource.DeferredResource):
-    def __init__(self, provider):
+    def __init__(self, provider, max_batch_size=0):
         deferred_resource.DeferredResource.__init__(self)
         self._provider = provider
+        self._max_batch_size = max_batch_size # batches longer than this are one invalid request; 0 refuses all batches
     
     @defer.inlineCallbacks
     def render_POST(self, request):
+        data = yield self.handle_data(request, request.content.read())
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Content-Length', len(data))
+        request.write(data)
+    
+    @defer.inlineCallbacks
+    def handle_data(self, request, data):
+        '''
+        Returns the JSON response to the request or batch in data. request is
+        only passed on to the provider's methods.
+        '''
+        
+        try:
+            req = json.loads(data)
+        except Exception:
+            resp = self._make_response(None, None, Error_for_code(-32700)(u'Parse error'))
+        else:
+            if isinstance(req, list) and 0 < len(req) <= self._max_batch_size:
+                resp = yield defer.gatherResults([self._handle_request(request, r) for r in req])
+            else:
+                resp = yield self._handle_request(request, req)
+        defer.returnValue(json.dumps(resp))
+    
+    def _make_response(self, id_, result, error):
+        return dict(
+            jsonrpc='2.0',
+            id=id_,
+            result=result,
+            error=error._to_obj() if error is not None else None,
+        )
+    
+    @defer.inlineCallbacks
+    def _handle_request(self, request, req):
         id_ = None
         
         try:
             try:
-                data = request.content.read()
-                
-                try:
-                    req = json.loads(data)
-                except Exception:
-                    raise Error_for_code(-32700)(u'Parse error')
+                if not isinstance(req, dict):
+                    raise Error_for_code(-32600)(u'Invalid Request')
                 
                 id_ = req.get('id', None)
                 method = req.get('method', None)
@@ -115,14 +356,6 @@ class Server(deferred_resource.DeferredResource):
                 raise Error_for_code(-32099)(u'Unknown error')
         except Error, e:
             result = None
-            error = e._to_obj()
+            error = e
         
-        data = json.dumps(dict(
-            jsonrpc='2.0',
-            id=id_,
-            result=result,
-            error=error,
-        ))
-        request.setHeader('Content-Type', 'application/json')
-        request.setHeader('Content-Length', len(data))
-        request.write(data)
+        defer.returnValue(self._make_response(id_, result, error))
@@ -72,6 +72,36 @@ add_dicts = add_dicts_ext()
 
 mult_dict = lambda c, x: dict((k, c*v) for k, v in x.iteritems())
 
+class SumDict(dict):
+    '''
+    dict that adds and subtracts elementwise, dropping keys that reach zero.
+    0 acts as the empty SumDict, so it can be used as an attribute delta value.
+    '''
+    
+    def __add__(self, other):
+        if not isinstance(other, dict):
+            assert other == 0
+            return self
+        res = SumDict(self)
+        for k, v in other.iteritems():
+            res[k] = res.get(k, 0) + v
+            if res[k] == 0:
+                del res[k]
+        return res
+    __radd__ = __add__
+    
+    def __neg__(self):
+        return SumDict((k, -v) for k, v in self.iteritems())
+    
+    def __sub__(self, other):
+        if not isinstance(other, dict):
+            assert other == 0
+            return self
+        return self + -SumDict(other)
+    
+    def __rsub__(self, other):
+        return -self + other
+
 def format(x):
     prefixes = 'kMGTPEZY'
     count = 0
@@ -9,7 +9,7 @@ from twisted.internet import protocol
 from twisted.python import log
 
 import p2pool
-from p2pool.util import datachunker, variable
+from p2pool.util import variable
 
 class TooLong(Exception):
     pass
@@ -18,7 +18,10 @@ class Protocol(protocol.Protocol):
     def __init__(self, message_prefix, max_payload_length, traffic_happened=variable.Event()):
         self._message_prefix = message_prefix
         self._max_payload_length = max_payload_length
-        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
+        self._header_length = len(message_prefix) + 12 + 4 + 4
+        self._recv_chunks = [] # received data not parsed yet
+        self._recv_length = 0
+        self._recv_wants = self._header_length # bytes needed before parsing can make progress
         self.paused_var = variable.Variable(False)
         self.traffic_happened = traffic_happened
     
@@ -36,24 +39,47 @@ class Protocol(protocol.Protocol):
     
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
-        self.dataReceived2(data)
+        self._recv_chunks.append(data)
+        self._recv_length += len(data)
+        if self._recv_length < self._recv_wants:
+            return
+        
+        # join only once enough has arrived, then parse every complete message in place
+        buf = ''.join(self._recv_chunks)
+        pos, wants = self.dataReceiver(buf)
+        self._recv_chunks = [buf[pos:]] if pos < len(buf) else []
+        self._recv_length = len(buf) - pos
+        self._recv_wants = wants
     
-    def dataReceiver(self):
+    def dataReceiver(self, buf):
+        '''
+        Handles all complete messages in buf, returning the position parsing
+        stopped at and how many bytes from there are needed to continue.
+        '''
+        prefix = self._message_prefix
+        header_length = self._header_length
+        pos = 0
         while True:
-            start = ''
-            while start != self._message_prefix:
-                start = (start + (yield 1))[-len(self._message_prefix):]
+            start = buf.find(prefix, pos)
+            if start == -1:
+                return max(pos, len(buf) - len(prefix) + 1), header_length # keep what could be the start of a split prefix
+            if len(buf) - start < header_length:
+                return start, header_length
             
-            command = (yield 12).rstrip('\0')
-            length, = struct.unpack('<I', (yield 4))
+            command, length, checksum = struct.unpack_from('<12sI4s', buf, start + len(prefix))
+            command = command.rstrip('\0')
             if length > self._max_payload_length:
                 print 'length too large'
+                pos = start + header_length - 4
                 continue
-            checksum = yield 4
-            payload = yield length
+            end = start + header_length + length
+            if len(buf) < end:
+                return start, end - start
+            pos = end
             
+            payload = buffer(buf, start + header_length, length)
             if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
-                print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex'), hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), payload.encode('hex')
+                print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex'), hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), str(payload).encode('hex')
                 continue
             
             type_ = getattr(self, 'message_' + command, None)
@@ -88,7 +114,10 @@ class Protocol(protocol.Protocol):
         if type_ is None:
             raise ValueError('invalid command')
         #print 'SEND', command, repr(payload2)[:500]
-        payload = type_.pack(payload2)
+        return self.sendPayload(command, type_.pack(payload2))
+    
+    def sendPayload(self, command, payload):
+        # payload must already be packed with message_<command>
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
         data = self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
@@ -62,7 +62,7 @@ class Type(object):
         obj = self._unpack(data)
         
         if p2pool.DEBUG:
-            if self._pack(obj) != data:
+            if self._pack(obj) != str(data): # data may be a buffer
                 raise AssertionError()
         
         return obj
@@ -1,3 +1,4 @@
+import collections
 import itertools
 import weakref
 
@@ -83,3 +84,138 @@ class Variable(object):
     
     def get_not_none(self):
         return self.get_when_satisfies(lambda val: val is not None)
+
+class VariableDict(Variable):
+    '''
+    Variable holding a dict that is modified in place. Instead of changed and
+    transitioned, observers are given only the difference: added fires with a
+    dict of the new items (keys already present are left alone) and removed
+    fires with a dict of the items that were removed. version counts
+    modifications.
+    '''
+    
+    def __init__(self, value):
+        Variable.__init__(self, value)
+        self.added = Event()
+        self.removed = Event()
+        self.version = 0
+    
+    def set(self, value):
+        raise TypeError('use add and remove to modify a VariableDict')
+    
+    def add(self, values):
+        new_items = dict((k, v) for k, v in values.iteritems() if k not in self.value)
+        if not new_items:
+            return
+        self.value.update(new_items)
+        self.version += 1
+        self.added.happened(new_items)
+    
+    def remove(self, keys):
+        missing_items = dict((k, self.value.pop(k)) for k in keys if k in self.value)
+        if not missing_items:
+            return
+        self.version += 1
+        self.removed.happened(missing_items)
+
+class BoundedVariableDict(VariableDict):
+    '''
+    VariableDict that keeps the total get_size() of its values under max_size.
+    
+    Sources (identified by any hashable) hold references to keys with
+    set_refs/add_refs/remove_refs. Referenced items are never evicted; once
+    over max_size, unreferenced items are evicted least recently used first,
+    where use is being added or losing the last reference.
+    remove_unreferenced() drops all unreferenced items at once.
+    '''
+    
+    def __init__(self, value, max_size=None, get_size=lambda value: 0):
+        VariableDict.__init__(self, {})
+        self.max_size = max_size
+        self.get_size = get_size
+        
+        self.size = 0
+        self.sizes = {} # key -> get_size(value)
+        self.ref_counts = {} # key -> number of sources referencing it
+        self.source_refs = {} # source -> set of keys
+        self.unreferenced = collections.OrderedDict() # key -> None, least recently used first
+        
+        self.add(value)
+    
+    def add(self, values):
+        for k, v in values.iteritems():
+            if k in self.value:
+                continue
+            self.sizes[k] = size = self.get_size(v)
+            self.size += size
+            if k not in self.ref_counts:
+                self.unreferenced[k] = None
+        VariableDict.add(self, values)
+        self._evict()
+    
+    def remove(self, keys):
+        keys = [k for k in keys if k in self.value]
+        for k in keys:
+            self.size -= self.sizes.pop(k)
+            self.unreferenced.pop(k, None)
+        VariableDict.remove(self, keys)
+    
+    def add_refs(self, source, keys):
+        refs = self.source_refs.setdefault(source, set())
+        for k in keys:
+            if k in refs:
+                continue
+            refs.add(k)
+            self.ref_counts[k] = self.ref_counts.get(k, 0) + 1
+            self.unreferenced.pop(k, None)
+    
+    def remove_refs(self, source, keys):
+        refs = self.source_refs.get(source, set())
+        for k in keys:
+            if k not in refs:
+                continue
+            refs.remove(k)
+            self.ref_counts[k] -= 1
+            if not self.ref_counts[k]:
+                del self.ref_counts[k]
+                if k in self.value:
+                    self.unreferenced[k] = None
+        if not refs:
+            self.source_refs.pop(source, None)
+        self._evict()
+    
+    def set_refs(self, source, keys):
+        keys = set(keys)
+        old_refs = self.source_refs.get(source, set())
+        self.add_refs(source, keys - old_refs)
+        self.remove_refs(source, old_refs - keys)
+    
+    def set_refs_and_add(self, source, values):
+        # referencing first keeps add's eviction from dropping the new values while the old refs still hold their space
+        self.set_refs(source, values)
+        self.add(values)
+    
+    def remove_unreferenced(self):
+        self.remove(list(self.unreferenced))
+    
+    def _evict(self):
+        if self.max_size is None or self.size <= self.max_size:
+            return
+        to_remove = []
+        size = self.size
+        for k in self.unreferenced:
+            if size <= self.max_size:
+                break
+            to_remove.append(k)
+            size -= self.sizes[k]
+        self.remove(to_remove)
+    
+    def get_stats(self):
+        return dict(
+            count=len(self.value),
+            size=self.size,
+            max_size=self.max_size,
+            referenced_count=len(self.value) - len(self.unreferenced),
+            unreferenced_count=len(self.unreferenced),
+            unreferenced_size=sum(self.sizes[k] for k in self.unreferenced),
+        )
@@ -13,7 +13,7 @@ from twisted.web import resource, static
 import p2pool
 from bitcoin import data as bitcoin_data
 from . import data as p2pool_data
-from util import deferred_resource, graph, math, pack
+from util import deferral, deferred_resource, graph, math, pack
 
 def _atomic_read(filename):
     try:
@@ -30,20 +30,6 @@ def _atomic_read(filename):
             raise
     return None
 
-def _atomic_write(filename, data):
-    with open(filename + '.new', 'wb') as f:
-        f.write(data)
-        f.flush()
-        try:
-            os.fsync(f.fileno())
-        except:
-            pass
-    try:
-        os.rename(filename + '.new', filename)
-    except: # XXX windows can't overwrite
-        os.remove(filename)
-        os.rename(filename + '.new', filename)
-
 def get_web_root(wb, datadir_path, bitcoind_warning_var):
     node = wb.node
     start_time = time.time()
@@ -122,17 +108,16 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
         
         global_stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, lookbehind)
         
-        my_unstale_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes)
-        my_orphan_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'orphan')
-        my_doa_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'doa')
+        my_delta = wb.tracker_view.get_delta(node.best_share_var.value, node.tracker.get_nth_parent_hash(node.best_share_var.value, lookbehind))
+        my_unstale_count = my_delta.my_count
+        my_orphan_count = my_delta.my_orphan_announce_count
+        my_doa_count = my_delta.my_dead_announce_count
         my_share_count = my_unstale_count + my_orphan_count + my_doa_count
         my_stale_count = my_orphan_count + my_doa_count
         
         my_stale_prop = my_stale_count/my_share_count if my_share_count != 0 else None
         
-        my_work = sum(bitcoin_data.target_to_average_attempts(share.target)
-            for share in node.tracker.get_chain(node.best_share_var.value, lookbehind - 1)
-            if share.hash in wb.my_share_hashes)
+        my_work = wb.tracker_view.get_delta(node.best_share_var.value, node.tracker.get_nth_parent_hash(node.best_share_var.value, lookbehind - 1)).my_work
         actual_time = (node.tracker.items[node.best_share_var.value].timestamp -
             node.tracker.items[node.tracker.get_nth_parent_hash(node.best_share_var.value, lookbehind - 1)].timestamp)
         share_att_s = my_work / actual_time
@@ -176,7 +161,7 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
             attempts_to_share=bitcoin_data.target_to_average_attempts(node.tracker.items[node.best_share_var.value].max_target),
             attempts_to_block=bitcoin_data.target_to_average_attempts(node.bitcoind_work.value['bits'].target),
             block_value=node.bitcoind_work.value['subsidy']*1e-8,
-            warnings=p2pool_data.get_warnings(node.tracker, node.best_share_var.value, node.net, bitcoind_warning_var.value, node.bitcoind_work.value),
+            warnings=p2pool_data.get_warnings(node.tracker, node.best_share_var.value, node.net, bitcoind_warning_var.value, node.bitcoind_work_freshness.value),
             donation_proportion=wb.donation_percentage/100,
         )
     
@@ -195,18 +180,26 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
             res = yield self.func(*self.args)
             defer.returnValue(json.dumps(res) if self.mime_type == 'application/json' else res)
     
+    # results of the expensive endpoints only change along with the share chain or work
+    result_cache = deferral.ResultCache(lambda: (node.best_share_var.value, node.bitcoind_work.changed.times, wb.new_work_event.times))
+    
     web_root.putChild('rate', WebInterface(lambda: p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, 720)/(1-p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, 720))))
     web_root.putChild('difficulty', WebInterface(lambda: bitcoin_data.target_to_difficulty(node.tracker.items[node.best_share_var.value].max_target)))
-    web_root.putChild('users', WebInterface(get_users))
+    web_root.putChild('users', WebInterface(result_cache(get_users)))
     web_root.putChild('user_stales', WebInterface(lambda: dict((bitcoin_data.pubkey_hash_to_address(ph, node.net.PARENT), prop) for ph, prop in
         p2pool_data.get_user_stale_props(node.tracker, node.best_share_var.value, node.tracker.get_height(node.best_share_var.value)).iteritems())))
     web_root.putChild('fee', WebInterface(lambda: wb.worker_fee))
-    web_root.putChild('current_payouts', WebInterface(lambda: dict((bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8) for script, value in node.get_current_txouts().iteritems())))
-    web_root.putChild('patron_sendmany', WebInterface(get_patron_sendmany, 'text/plain'))
-    web_root.putChild('global_stats', WebInterface(get_global_stats))
-    web_root.putChild('local_stats', WebInterface(get_local_stats))
+    web_root.putChild('current_payouts', WebInterface(result_cache(lambda: dict((bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8) for script, value in node.get_current_txouts().iteritems()))))
+    web_root.putChild('patron_sendmany', WebInterface(result_cache(get_patron_sendmany), 'text/plain'))
+    web_root.putChild('global_stats', WebInterface(result_cache(get_global_stats)))
+    web_root.putChild('local_stats', WebInterface(result_cache(get_local_stats)))
     web_root.putChild('peer_addresses', WebInterface(lambda: ['%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port) for peer in node.p2p_node.peers.itervalues()]))
     web_root.putChild('peer_txpool_sizes', WebInterface(lambda: dict(('%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port), peer.remembered_txs_size) for peer in node.p2p_node.peers.itervalues())))
+    web_root.putChild('peer_share_latencies', WebInterface(lambda: dict(('%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port), math.mean(peer.share_latencies) if peer.share_latencies else None) for peer in node.p2p_node.peers.itervalues())))
+    web_root.putChild('bitcoind_rpc_stats', WebInterface(node.bitcoind.get_stats))
+    web_root.putChild('tx_pool', WebInterface(node.known_txs_var.get_stats))
+    web_root.putChild('merged_stats', WebInterface(wb.merged_work_manager.get_stats))
+    web_root.putChild('block_submissions', WebInterface(node.block_submitter.get_stats))
     web_root.putChild('pings', WebInterface(defer.inlineCallbacks(lambda: defer.returnValue(
         dict([(a, (yield b)) for a, b in
             [(
@@ -219,14 +212,15 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
     ))))
     web_root.putChild('peer_versions', WebInterface(lambda: dict(('%s:%i' % peer.addr, peer.other_sub_version) for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('payout_addr', WebInterface(lambda: bitcoin_data.pubkey_hash_to_address(wb.my_pubkey_hash, node.net.PARENT)))
-    web_root.putChild('recent_blocks', WebInterface(lambda: [dict(
+    web_root.putChild('recent_blocks', WebInterface(result_cache(lambda: [dict(
         ts=s.timestamp,
         hash='%064x' % s.header_hash,
         number=pack.IntType(24).unpack(s.share_data['coinbase'][1:4]),
         share='%064x' % s.hash,
-    ) for s in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 24*60*60//node.net.SHARE_PERIOD)) if s.pow_hash <= s.header['bits'].target]))
+    ) for s in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 24*60*60//node.net.SHARE_PERIOD)) if s.pow_hash <= s.header['bits'].target])))
     web_root.putChild('uptime', WebInterface(lambda: time.time() - start_time))
-    web_root.putChild('stale_rates', WebInterface(lambda: p2pool_data.get_stale_counts(node.tracker, node.best_share_var.value, 720, rates=True)))
+    web_root.putChild('stale_rates', WebInterface(result_cache(lambda: p2pool_data.get_stale_counts(node.tracker, node.best_share_var.value, 720, rates=True))))
+    web_root.putChild('cache_stats', WebInterface(result_cache.get_stats))
     
     new_root = resource.Resource()
     web_root.putChild('web', new_root)
@@ -334,14 +328,6 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
     )))
     new_root.putChild('version', WebInterface(lambda: p2pool.__version__))
     
-    hd_path = os.path.join(datadir_path, 'graph_db')
-    hd_data = _atomic_read(hd_path)
-    hd_obj = {}
-    if hd_data is not None:
-        try:
-            hd_obj = json.loads(hd_data)
-        except Exception:
-            log.err(None, 'Error reading graph database:')
     dataview_descriptions = {
         'last_hour': graph.DataViewDescription(150, 60*60),
         'last_day': graph.DataViewDescription(300, 60*60*24),
@@ -368,7 +354,7 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
             last_bin_end = desired_versions['last_bin_end']
             bins = [dict((name, (total*get_total_pool_rate(last_bin_end - (i+1/2)*dv_desc.bin_width), count)) for name, (total, count) in desired_versions['bins'][i].iteritems()) for i in xrange(dv_desc.bin_count)]
         return graph.DataView(dv_desc, ds_desc, last_bin_end, bins)
-    hd = graph.HistoryDatabase.from_obj({
+    datastream_descriptions = {
         'local_hash_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False),
         'local_dead_hash_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False),
         'local_share_hash_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False),
@@ -387,8 +373,19 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
             multivalue_undefined_means_0=True, default_func=build_desired_rates),
         'traffic_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False, multivalues=True),
         'getwork_latency': graph.DataStreamDescription(dataview_descriptions),
-    }, hd_obj)
-    task.LoopingCall(lambda: _atomic_write(hd_path, json.dumps(hd.to_obj()))).start(100)
+    }
+    hd_path = os.path.join(datadir_path, 'graph_db')
+    hd_file = graph.HistoryFile(hd_path + '.bin', datastream_descriptions)
+    hd_obj = {}
+    if hd_file.created: # import old JSON database, if present
+        hd_data = _atomic_read(hd_path)
+        if hd_data is not None:
+            try:
+                hd_obj = json.loads(hd_data)
+            except Exception:
+                log.err(None, 'Error reading graph database:')
+    hd = graph.HistoryDatabase.from_file(datastream_descriptions, hd_file, hd_obj)
+    task.LoopingCall(hd_file.flush).start(100)
     @wb.pseudoshare_received.watch
     def _(work, dead, user):
         t = time.time()
@@ -432,9 +429,9 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var):
         hd.datastreams['desired_versions'].add_datum(t, dict((str(k), v/vs_total) for k, v in vs.iteritems()))
         hd.datastreams['desired_version_rates'].add_datum(t, dict((str(k), v/vs_total*pool_total) for k, v in vs.iteritems()))
     task.LoopingCall(add_point).start(5)
-    @node.bitcoind_work.changed.watch
-    def _(new_work):
-        hd.datastreams['getwork_latency'].add_datum(time.time(), new_work['latency'])
+    @node.bitcoind_work_freshness.changed.watch
+    def _(new_freshness):
+        hd.datastreams['getwork_latency'].add_datum(time.time(), new_freshness['latency'])
     new_root.putChild('graph_data', WebInterface(lambda source, view: hd.datastreams[source].dataviews[view].get_data(time.time())))
     
     web_root.putChild('static', static.File(os.path.join(os.path.dirname(sys.argv[0]), 'web-static')))
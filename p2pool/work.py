@@ -1,6 +1,7 @@
 from __future__ import division
 
 import base64
+import collections
 import random
 import sys
 import time
@@ -9,12 +10,110 @@ from twisted.internet import defer
 from twisted.python import log
 
 import bitcoin.getwork as bitcoin_getwork, bitcoin.data as bitcoin_data
-from bitcoin import helper, script, worker_interface
+from bitcoin import script, worker_interface
 from util import forest, jsonrpc, variable, deferral, math, pack
 import p2pool, p2pool.data as p2pool_data
 
+class MergedWorkManager(object):
+    '''
+    Keeps merged_work (chain id -> dict(hash, target, merged_proxy)) up to date
+    by calling getauxblock on every merged mining daemon at once, every
+    poll_interval seconds, over one kept-alive connection each. merged_work
+    only changes when some chain's hash or target does, and then only once per
+    round. The auxpow tree layout and coinbase commitment (mm_data, mm_later)
+    are recomputed only on those changes.
+    '''
+    
+    def __init__(self, merged_urls, poll_interval=1, error_delay=30):
+        self.poll_interval = poll_interval
+        self.error_delay = error_delay
+        
+        self.chains = [dict(
+            url=merged_url,
+            proxy=jsonrpc.Proxy(merged_url, dict(Authorization='Basic ' + base64.b64encode(merged_userpass)), persistent_connections=1),
+            chain_id=None,
+            next_poll=0,
+            latency=None,
+            requests=0,
+            errors=0,
+        ) for merged_url, merged_userpass in merged_urls]
+        
+        self.merged_work = variable.Variable({})
+        self.mm_data, self.mm_later = '', []
+        self.merged_work.changed.watch(self._update_commitment)
+        
+        self.running = False
+    
+    def start(self):
+        self.running = True
+        if self.chains:
+            self._poll_loop()
+    
+    def stop(self):
+        self.running = False
+        for chain in self.chains:
+            chain['proxy'].close()
+    
+    @defer.inlineCallbacks
+    def _poll_loop(self):
+        while self.running:
+            now = time.time()
+            results = yield defer.DeferredList([self._poll(chain) for chain in self.chains if chain['next_poll'] <= now])
+            
+            new_merged_work = dict(self.merged_work.value)
+            for success, result in results:
+                if not success or result is None:
+                    continue
+                chain_id, aux_work = result
+                old_aux_work = new_merged_work.get(chain_id, None)
+                if old_aux_work is None or (old_aux_work['hash'], old_aux_work['target']) != (aux_work['hash'], aux_work['target']):
+                    new_merged_work[chain_id] = aux_work
+            self.merged_work.set(new_merged_work)
+            
+            yield deferral.sleep(self.poll_interval)
+    
+    @defer.inlineCallbacks
+    def _poll(self, chain):
+        chain['requests'] += 1
+        start = time.time()
+        try:
+            auxblock = yield chain['proxy'].rpc_getauxblock()
+        except:
+            log.err(None, 'Error while calling merged getauxblock:')
+            chain['errors'] += 1
+            chain['next_poll'] = time.time() + self.error_delay
+            return
+        chain['latency'] = time.time() - start
+        chain['chain_id'] = auxblock['chainid']
+        defer.returnValue((auxblock['chainid'], dict(
+            hash=int(auxblock['hash'], 16),
+            target='p2pool' if auxblock['target'] == 'p2pool' else pack.IntType(256).unpack(auxblock['target'].decode('hex')),
+            merged_proxy=chain['proxy'],
+        )))
+    
+    def _update_commitment(self, merged_work):
+        if not merged_work:
+            self.mm_data, self.mm_later = '', []
+            return
+        tree, size = bitcoin_data.make_auxpow_tree(merged_work)
+        mm_hashes = [merged_work.get(tree.get(i), dict(hash=0))['hash'] for i in xrange(size)]
+        self.mm_data = '\xfa\xbemm' + bitcoin_data.aux_pow_coinbase_type.pack(dict(
+            merkle_root=bitcoin_data.merkle_hash(mm_hashes),
+            size=size,
+            nonce=0,
+        ))
+        self.mm_later = [(aux_work, mm_hashes.index(aux_work['hash']), mm_hashes) for chain_id, aux_work in merged_work.iteritems()]
+    
+    def get_stats(self):
+        return dict((chain['url'], dict(
+            chain_id=chain['chain_id'],
+            latency=chain['latency'],
+            requests=chain['requests'],
+            errors=chain['errors'],
+        )) for chain in self.chains)
+
 class WorkerBridge(worker_interface.WorkerBridge):
-    def __init__(self, node, my_pubkey_hash, donation_percentage, merged_urls, worker_fee):
+    def __init__(self, node, my_pubkey_hash, donation_percentage, merged_urls, worker_fee, max_user_details=10000):
         worker_interface.WorkerBridge.__init__(self)
         self.recent_shares_ts_work = []
         
@@ -23,6 +122,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.donation_percentage = donation_percentage
         self.worker_fee = worker_fee
         
+        self.max_user_details = max_user_details
+        self.user_details = collections.OrderedDict() # username -> parsed details, least recently used first
+        
         self.running = True
         self.pseudoshare_received = variable.Event()
         self.share_received = variable.Event()
@@ -40,6 +142,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             my_doa_count=lambda share: 1 if share.hash in self.my_doa_share_hashes else 0,
             my_orphan_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'orphan' else 0,
             my_dead_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'doa' else 0,
+            my_work=lambda share: bitcoin_data.target_to_average_attempts(share.target) if share.hash in self.my_share_hashes else 0,
         )))
         
         @self.node.tracker.verified.removed.watch
@@ -56,21 +159,9 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         # MERGED WORK
         
-        self.merged_work = variable.Variable({})
-        
-        @defer.inlineCallbacks
-        def set_merged_work(merged_url, merged_userpass):
-            merged_proxy = jsonrpc.Proxy(merged_url, dict(Authorization='Basic ' + base64.b64encode(merged_userpass)))
-            while self.running:
-                auxblock = yield deferral.retry('Error while calling merged getauxblock:', 30)(merged_proxy.rpc_getauxblock)()
-                self.merged_work.set(dict(self.merged_work.value, **{auxblock['chainid']: dict(
-                    hash=int(auxblock['hash'], 16),
-                    target='p2pool' if auxblock['target'] == 'p2pool' else pack.IntType(256).unpack(auxblock['target'].decode('hex')),
-                    merged_proxy=merged_proxy,
-                )}))
-                yield deferral.sleep(1)
-        for merged_url, merged_userpass in merged_urls:
-            set_merged_work(merged_url, merged_userpass)
+        self.merged_work_manager = MergedWorkManager(merged_urls)
+        self.merged_work = self.merged_work_manager.merged_work
+        self.merged_work_manager.start()
         
         @self.merged_work.changed.watch
         def _(new_merged_work):
@@ -80,7 +171,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         self.current_work = variable.Variable(None)
         def compute_work():
-            t = self.node.bitcoind_work.value
+            t = self.node.bitcoind_work.value # the template's time changes on every poll, so get_work reads it from bitcoind_work_freshness
             bb = self.node.best_block_header.value
             if bb is not None and bb['previous_block'] == t['previous_block'] and self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(bb)) <= t['bits'].target:
                 print 'Skipping from block %x to block %x!' % (bb['previous_block'],
@@ -95,7 +186,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     transactions=[],
                     merkle_link=bitcoin_data.calculate_merkle_link([None], 0),
                     subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.node.bitcoind_work.value['height']),
-                    last_update=self.node.bitcoind_work.value['last_update'],
                 )
             
             self.current_work.set(t)
@@ -114,6 +204,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
     
     def stop(self):
         self.running = False
+        self.merged_work_manager.stop()
     
     def get_stale_counts(self):
         '''Returns (orphans, doas), total, (orphans_recorded_in_chain, doas_recorded_in_chain)'''
@@ -131,8 +222,20 @@ class WorkerBridge(worker_interface.WorkerBridge):
         return (my_shares_not_in_chain - my_doa_shares_not_in_chain, my_doa_shares_not_in_chain), my_shares, (orphans_recorded_in_chain, doas_recorded_in_chain)
     
     def get_user_details(self, request):
-        user = request.getUser() if request.getUser() is not None else ''
-        
+        username = request.getUser() if request.getUser() is not None else ''
+        details = self.user_details.pop(username, None)
+        if details is None:
+            details = self._parse_username(username)
+        self.user_details[username] = details
+        if len(self.user_details) > self.max_user_details:
+            self.user_details.popitem(last=False)
+        
+        user, pubkey_hash, desired_share_target, desired_pseudoshare_target = details
+        if random.uniform(0, 100) < self.worker_fee or pubkey_hash is None:
+            pubkey_hash = self.my_pubkey_hash
+        return user, pubkey_hash, desired_share_target, desired_pseudoshare_target
+    
+    def _parse_username(self, user):
         desired_pseudoshare_target = None
         if '+' in user:
             user, desired_pseudoshare_difficulty_str = user.rsplit('+', 1)
@@ -149,13 +252,10 @@ class WorkerBridge(worker_interface.WorkerBridge):
             except:
                 pass
         
-        if random.uniform(0, 100) < self.worker_fee:
-            pubkey_hash = self.my_pubkey_hash
-        else:
-            try:
-                pubkey_hash = bitcoin_data.address_to_pubkey_hash(user, self.node.net.PARENT)
-            except: # XXX blah
-                pubkey_hash = self.my_pubkey_hash
+        try:
+            pubkey_hash = bitcoin_data.address_to_pubkey_hash(user, self.node.net.PARENT)
+        except: # XXX blah
+            pubkey_hash = None # mine to my_pubkey_hash
         
         return user, pubkey_hash, desired_share_target, desired_pseudoshare_target
     
@@ -168,21 +268,10 @@ class WorkerBridge(worker_interface.WorkerBridge):
             raise jsonrpc.Error_for_code(-12345)(u'p2pool is not connected to any peers')
         if self.node.best_share_var.value is None and self.node.net.PERSIST:
             raise jsonrpc.Error_for_code(-12345)(u'p2pool is downloading shares')
-        if time.time() > self.current_work.value['last_update'] + 60:
+        if time.time() > self.node.bitcoind_work_freshness.value['last_update'] + 60:
             raise jsonrpc.Error_for_code(-12345)(u'lost contact with bitcoind')
         
-        if self.merged_work.value:
-            tree, size = bitcoin_data.make_auxpow_tree(self.merged_work.value)
-            mm_hashes = [self.merged_work.value.get(tree.get(i), dict(hash=0))['hash'] for i in xrange(size)]
-            mm_data = '\xfa\xbemm' + bitcoin_data.aux_pow_coinbase_type.pack(dict(
-                merkle_root=bitcoin_data.merkle_hash(mm_hashes),
-                size=size,
-                nonce=0,
-            ))
-            mm_later = [(aux_work, mm_hashes.index(aux_work['hash']), mm_hashes) for chain_id, aux_work in self.merged_work.value.iteritems()]
-        else:
-            mm_data = ''
-            mm_later = []
+        mm_data, mm_later = self.merged_work_manager.mm_data, self.merged_work_manager.mm_later
         
         tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in self.current_work.value['transactions']]
         tx_map = dict(zip(tx_hashes, self.current_work.value['transactions']))
@@ -267,7 +356,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             version=min(self.current_work.value['version'], 2),
             previous_block=self.current_work.value['previous_block'],
             merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(bitcoin_data.tx_type.pack(transactions[0])), merkle_link),
-            timestamp=self.current_work.value['time'],
+            timestamp=self.current_work.value['time'] if 'time' in self.current_work.value else self.node.bitcoind_work_freshness.value['time'],
             bits=self.current_work.value['bits'],
             share_target=target,
         )
@@ -279,7 +368,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
             try:
                 if pow_hash <= header['bits'].target or p2pool.DEBUG:
-                    helper.submit_block(dict(header=header, txs=transactions), False, self.node.factory, self.node.bitcoind, self.node.bitcoind_work, self.node.net)
+                    self.node.block_submitter.submit(dict(header=header, txs=transactions), False)
                     if pow_hash <= header['bits'].target:
                         print
                         print 'GOT BLOCK FROM MINER! Passing to bitcoind! %s%064x' % (self.node.net.PARENT.BLOCK_EXPLORER_URL_PREFIX, header_hash)